@@ -24,7 +24,9 @@ COPYRIGHT: (C) 2019 Brendan Harmon and the GRASS Development Team
 
 #%option G_OPT_R_ELEV
 #% key: elevation
+#% description: Name of elevation raster map or maps of a time series
 #% required: yes
+#% multiple: yes
 #% guisection: Basic
 #%end
 
@@ -70,12 +72,20 @@ COPYRIGHT: (C) 2019 Brendan Harmon and the GRASS Development Team
 #%option
 #% key: rain_duration
 #% type: integer
-#% description: Total duration of storm event in minutes
+#% description: Total duration of storm event or duration of each time step of a rainfall time series in minutes
 #% multiple: no
 #% required: no
 #% guisection: Input
 #%end
 
+#%option G_OPT_STRDS_INPUT
+#% key: rainfall
+#% description: Space time raster dataset of rainfall intensity in mm/hr
+#% label: Rainfall time series
+#% required: no
+#% guisection: Input
+#%end
+
 #%option
 #% key: k_factor_value
 #% type: double
@@ -142,23 +152,270 @@ COPYRIGHT: (C) 2019 Brendan Harmon and the GRASS Development Team
 
 #%option G_OPT_R_OUTPUT
 #% key: flow_accumulation
-#% answer: flow_accumulation
-#% required: yes
+#% required: no
 #% description: Flow accumulation map
 #% guisection: Output
 #%end
 
 #%option G_OPT_R_OUTPUT
 #% key: ls_factor
-#% answer: ls_factor
 #% description: Dimensionless topographic factor map
-#% required: yes
+#% required: no
+#% guisection: Output
+#%end
+
+#%option
+#% key: members
+#% type: integer
+#% description: Number of Monte Carlo ensemble members
+#% label: Ensemble members
+#% required: no
+#% guisection: Uncertainty
+#%end
+
+#%option
+#% key: r_factor_stddev
+#% type: double
+#% description: Standard deviation of the erosivity factor
+#% label: R factor standard deviation
+#% answer: 0.0
+#% guisection: Uncertainty
+#%end
+
+#%option
+#% key: k_factor_stddev
+#% type: double
+#% description: Standard deviation of the soil erodibility factor
+#% label: K factor standard deviation
+#% answer: 0.0
+#% guisection: Uncertainty
+#%end
+
+#%option
+#% key: c_factor_stddev
+#% type: double
+#% description: Standard deviation of the land cover factor
+#% label: C factor standard deviation
+#% answer: 0.0
+#% guisection: Uncertainty
+#%end
+
+#%option
+#% key: m_coeff_stddev
+#% type: double
+#% description: Standard deviation of the water flow exponent
+#% label: Water flow exponent standard deviation
+#% answer: 0.0
+#% guisection: Uncertainty
+#%end
+
+#%option
+#% key: n_coeff_stddev
+#% type: double
+#% description: Standard deviation of the slope exponent
+#% label: Slope exponent standard deviation
+#% answer: 0.0
+#% guisection: Uncertainty
+#%end
+
+#%option
+#% key: seed
+#% type: integer
+#% description: Seed for sampling ensemble members
+#% label: Random seed
+#% required: no
+#% guisection: Uncertainty
+#%end
+
+#%option
+#% key: batch
+#% type: integer
+#% description: Number of ensemble members evaluated together
+#% label: Ensemble batch size
+#% answer: 10
+#% guisection: Uncertainty
+#%end
+
+#%option
+#% key: percentiles
+#% type: double
+#% description: Percentiles of erosion across ensemble members
+#% label: Percentiles
+#% options: 0-100
+#% multiple: yes
+#% required: no
+#% guisection: Uncertainty
+#%end
+
+#%option G_OPT_R_OUTPUT
+#% key: erosion_mean
+#% required: no
+#% description: Mean erosion of ensemble members
+#% guisection: Uncertainty
+#%end
+
+#%option G_OPT_R_OUTPUT
+#% key: erosion_stddev
+#% required: no
+#% description: Standard deviation of erosion of ensemble members
+#% guisection: Uncertainty
+#%end
+
+#%option G_OPT_R_BASENAME_OUTPUT
+#% key: erosion_percentile
+#% required: no
+#% description: Basename for erosion percentile maps of ensemble members
+#% guisection: Uncertainty
+#%end
+
+#%option G_OPT_R_BASENAME_OUTPUT
+#% key: erosion_difference
+#% required: no
+#% description: Basename for maps of the difference in erosion between epochs
+#% guisection: Output
+#%end
+
+#%option G_OPT_MEMORYMB
+#%end
+
+#%option G_OPT_M_NPROCS
+#%end
+
+#%option G_OPT_M_COORDS
+#% key: coordinates
+#% description: Coordinates of points to query erosion at
+#% label: Query points
+#% required: no
+#% multiple: yes
+#% guisection: Query
+#%end
+
+#%option G_OPT_V_MAP
+#% key: aoi
+#% description: Vector map of small areas of interest to query erosion in
+#% label: Query areas of interest
+#% required: no
+#% guisection: Query
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: table
+#% description: Table of queried erosion (default: standard output)
+#% label: Query table
+#% required: no
+#% guisection: Query
+#%end
+
+#%option
+#% key: scratch
+#% type: string
+#% gisprompt: old,dir,dir
+#% description: Fast directory such as /dev/shm for a scratch mapset of intermediate maps
+#% label: Scratch directory
+#% required: no
+#% guisection: Settings
+#%end
+
+#%option
+#% key: export
+#% type: string
+#% gisprompt: new,dir,dir
+#% description: Directory for Cloud Optimized GeoTIFFs of output maps
+#% label: Export directory
+#% required: no
 #% guisection: Output
 #%end
 
+#%option
+#% key: stack
+#% type: string
+#% gisprompt: new,file,file
+#% description: Array store for erosion, LS factor and flow accumulation of each scenario
+#% label: Output array store
+#% required: no
+#% guisection: Stack
+#%end
+
+#%option
+#% key: stack_format
+#% type: string
+#% options: zarr,netcdf
+#% description: Format of the array store
+#% descriptions: zarr;Zarr directory store;netcdf;NetCDF4 file
+#% label: Array store format
+#% answer: zarr
+#% guisection: Stack
+#%end
 
+#%option
+#% key: scenario
+#% type: string
+#% description: Name of the scenario in the array store (default: erosion map name)
+#% label: Scenario name
+#% required: no
+#% guisection: Stack
+#%end
+
+#%option
+#% key: tile
+#% type: integer
+#% description: Size of the square chunks of the array store in cells
+#% label: Chunk size
+#% answer: 256
+#% guisection: Stack
+#%end
+
+#%flag
+#% key: c
+#% description: Checkpoint completed stages and resume from them on rerun
+#% label: Checkpoint and resume
+#%end
+
+#%option
+#% key: cache_size
+#% type: double
+#% description: Size limit of the cache of outputs of identical runs (MB)
+#% label: Cache size
+#% required: no
+#% guisection: Settings
+#%end
+
+#%flag
+#% key: i
+#% description: Invalidate the cache of outputs of identical runs and exit
+#% label: Invalidate cache
+#% suppress_required: yes
+#%end
+
+#%flag
+#% key: f
+#% description: Evaluate the LS factor of ensembles by table lookup
+#% label: Fast math
+#%end
+
+#%flag
+#% key: t
+#% description: Calibrate the estimated costs of stages with their runtime
+#% label: Calibrate costs
+#%end
+
+#%flag
+#% key: e
+#% description: Estimate runtime, memory and disk space and exit
+#% label: Estimate costs
+#%end
+
+
+import os
 import sys
+import json
+import math
+import time
+import threading
 import atexit
+import shutil
+import hashlib
+from multiprocessing.pool import ThreadPool
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
 
@@ -196,6 +453,604 @@ lsfactor_colors = """\
 100% #652915
 """
 
+# null value of integer raster maps
+CELL_NULL = -2147483648
+
+# default costs per cell of each stage as seconds,
+# bytes of memory and bytes of temporary maps,
+# with seconds calibrated from runs with the -t flag in the mapset
+stage_costs = {
+    'r_factor': (2e-8, 0, 8),
+    'k_factor': (2e-8, 0, 8),
+    'c_factor': (2e-8, 0, 8),
+    'event_r_factor': (1e-7, 0, 32),
+    'space_time_r_factor': (3e-8, 32, 8),
+    'slope': (3e-7, 0, 12),
+    'slope_aspect': (6e-7, 0, 24),
+    'flow_accumulation': (1.5e-6, 31, 8),
+    'rusle_ls_factor': (1e-7, 0, 0),
+    'rusle_erosion': (1.5e-7, 0, 0),
+    'rusle_ensemble': (5e-8, 0, 0),
+    'usped_ls_factor': (1e-7, 0, 0),
+    'sediment_flow': (2.5e-7, 0, 16),
+    'divergence': (8e-7, 0, 32),
+    'erosion_deposition': (1e-7, 0, 0)}
+
+
+class Checkpoint(object):
+    """Record of completed model stages for resuming interrupted runs
+
+    Each stage is keyed by a hash of its name, parameters, outputs,
+    the current region and mask, and the identity of its input maps.
+    Inputs produced by an earlier stage are identified by that stage's key
+    so that a changed input invalidates every stage downstream of it.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.stages = {}
+        self.keys = {}
+        self.pending = {}
+        self.region = None
+        self.lock = threading.Lock()
+        self.started = {}
+        self.timings = {}
+
+    def load(self):
+        """Read the checkpoint file of the current mapset"""
+        self.path = os.path.join(module_directory(), 'checkpoint.json')
+        self.enabled = True
+        if os.path.exists(self.path):
+            with open(self.path) as checkpoint_file:
+                try:
+                    self.stages = json.load(checkpoint_file)
+                except ValueError:
+                    gscript.warning(
+                        "Ignoring unreadable checkpoint file {path}".format(
+                            path=self.path))
+                    self.stages = {}
+
+    def save(self):
+        """Write the checkpoint file"""
+        with open(self.path, 'w') as checkpoint_file:
+            json.dump(self.stages, checkpoint_file, indent=2, sort_keys=True)
+
+    def signature(self, name):
+        """Identify an input map by its producing stage or its files"""
+        if name in self.keys:
+            return self.keys[name]
+        return map_signature(name)
+
+    def start(self, name, inputs, outputs, params=()):
+        """Return True if a stage needs to be computed,
+        or False if it is resumed from a valid checkpoint"""
+        self.started[name] = time.time()
+        if not self.enabled:
+            return True
+        if self.region is None:
+            self.region = [
+                sorted(gscript.parse_command('g.region', flags='g').items()),
+                map_signature('MASK')]
+        key = hashlib.sha1(json.dumps(
+            [name,
+             [str(param) for param in params],
+             outputs,
+             [self.signature(input_map) for input_map in inputs
+              if input_map],
+             self.region]).encode('utf-8')).hexdigest()
+        stage = self.stages.get(name)
+        if (stage
+                and stage['key'] == key
+                and stage['outputs'] == [map_signature(output)
+                                         for output in outputs]):
+            gscript.message(
+                "Resuming stage {name} from checkpoint".format(name=name))
+            for output in outputs:
+                self.keys[output] = key
+            return False
+        self.pending[name] = (key, outputs)
+        return True
+
+    def finish(self, name):
+        """Record a completed stage"""
+        self.timings[name] = time.time() - self.started.pop(name)
+        if not self.enabled:
+            return
+        key, outputs = self.pending.pop(name)
+        signatures = [map_signature(output) for output in outputs]
+        with self.lock:
+            for output in outputs:
+                self.keys[output] = key
+            self.stages[name] = {'key': key, 'outputs': signatures}
+            self.save()
+
+
+checkpoint = Checkpoint()
+
+class Exporter(object):
+    """Export of output maps as Cloud Optimized GeoTIFFs
+
+    Maps are exported as soon as the model for their epoch is complete
+    as internally tiled and compressed GeoTIFFs with overviews.
+    Their color tables are written to sidecar color files
+    that can be used by gdaldem color-relief.
+    """
+
+    def __init__(self):
+        self.directory = None
+
+    def export(self, name):
+        """Export a map and its color table if exporting"""
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, name)
+        gscript.run_command(
+            'r.out.gdal',
+            input=name,
+            output=path + '.tif',
+            format='COG',
+            type='Float32',
+            createopt=['COMPRESS=DEFLATE',
+                       'PREDICTOR=3',
+                       'BLOCKSIZE=512',
+                       'OVERVIEWS=AUTO',
+                       'RESAMPLING=AVERAGE'],
+            flags='c',
+            overwrite=True,
+            quiet=True)
+        rules = gscript.read_command('r.colors.out', map=name)
+        with open(path + '.txt', 'w') as color_file:
+            for line in rules.splitlines():
+                if not line.startswith('default'):
+                    color_file.write(line + '\n')
+
+
+exporter = Exporter()
+
+def create_mapset(mapset, directory=None):
+    """Create a mapset with the region and search path of the current mapset,
+    optionally linked into the location from another directory,
+    and return the path of a gisrc file for it"""
+    env = gscript.gisenv()
+    location = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+    path = os.path.join(location, mapset)
+    if directory:
+        directory = os.path.join(directory, mapset)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.remove(path)
+        if not os.path.lexists(path):
+            os.symlink(directory, path)
+    elif not os.path.isdir(path):
+        os.makedirs(path)
+
+    # copy the region and search path of the current mapset
+    shutil.copy(
+        os.path.join(location, env['MAPSET'], 'WIND'),
+        os.path.join(path, 'WIND'))
+    mapsets = gscript.read_command(
+        'g.mapsets',
+        flags='p',
+        separator='newline').split()
+    with open(os.path.join(path, 'SEARCH_PATH'), 'w') as search_path:
+        search_path.write('\n'.join(
+            [mapset, env['MAPSET']]
+            + [name for name in mapsets
+               if name not in [mapset, env['MAPSET']]]) + '\n')
+
+    # write a gisrc file with the mapset as current mapset
+    with open(os.environ['GISRC']) as gisrc:
+        lines = [line for line in gisrc if not line.startswith('MAPSET:')]
+    lines.append('MAPSET: {mapset}\n'.format(mapset=mapset))
+    gisrc = os.path.join(path, 'gisrc')
+    with open(gisrc, 'w') as mapset_gisrc:
+        mapset_gisrc.writelines(lines)
+    return gisrc
+
+
+class Scratch(object):
+    """Temporary mapset on a fast path for intermediate maps
+
+    The scratch mapset is linked into the location from a directory
+    on fast local storage such as /dev/shm or NVMe
+    and becomes the current mapset of the module,
+    searching the target mapset and its search path for input maps.
+    Only output maps are copied into the target mapset.
+    """
+
+    def __init__(self):
+        self.mapset = None
+        self.directory = None
+        self.link = None
+        self.gisrc = None
+
+    def create(self, path, keep=False):
+        """Create the scratch mapset and make it the current mapset"""
+        env = gscript.gisenv()
+        location = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+        target = env['MAPSET']
+        self.gisrc = os.environ['GISRC']
+
+        # reuse the scratch mapset of checkpointed runs
+        if keep:
+            self.mapset = 'r_erosion_scratch_{mapset}'.format(mapset=target)
+        else:
+            self.mapset = 'r_erosion_scratch_{mapset}_{pid}'.format(
+                mapset=target,
+                pid=os.getpid())
+        self.directory = os.path.join(path, self.mapset)
+        self.link = os.path.join(location, self.mapset)
+
+        # switch to the scratch mapset
+        os.environ['GISRC'] = create_mapset(self.mapset, path)
+
+        # copy the mask unless it is unchanged since the last run
+        mask = os.path.join(location, target, 'cell', 'MASK')
+        scratch_mask = os.path.join(self.directory, 'cell', 'MASK')
+        if not os.path.exists(mask):
+            if os.path.exists(scratch_mask):
+                gscript.run_command(
+                    'g.remove',
+                    type='raster',
+                    name='MASK',
+                    flags='f',
+                    quiet=True)
+        elif (not os.path.exists(scratch_mask)
+                or os.path.getmtime(scratch_mask) < os.path.getmtime(mask)):
+            gscript.run_command(
+                'g.copy',
+                raster=['MASK@{mapset}'.format(mapset=target), 'MASK'],
+                overwrite=True,
+                quiet=True)
+
+    def finish(self, outputs):
+        """Copy output maps into the target mapset
+        and switch back to the target mapset"""
+        if not self.mapset:
+            return
+        os.environ['GISRC'] = self.gisrc
+        for output in outputs:
+            gscript.run_command(
+                'g.copy',
+                raster=['{name}@{mapset}'.format(
+                    name=output,
+                    mapset=self.mapset), output],
+                overwrite=True,
+                quiet=True)
+
+    def remove(self):
+        """Remove the scratch mapset"""
+        if not self.mapset:
+            return
+        os.environ['GISRC'] = self.gisrc
+        if os.path.islink(self.link):
+            os.remove(self.link)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+scratch = Scratch()
+
+class Cache(object):
+    """Store of the outputs of earlier runs for reuse by identical runs
+
+    Each run is keyed by a hash of the module source, its parameters,
+    the current region and mask, and the identity of its input maps.
+    The outputs of a run are copied into a cache mapset
+    and copied back by a later run with the same key.
+    The least recently used runs are removed
+    when the cache exceeds its size limit.
+    """
+
+    mapset = 'r_erosion_cache'
+
+    def __init__(self):
+        self.size = 0
+        self.key = None
+        self.target = None
+        self.directory = None
+        self.gisrc = None
+        self.runs = {}
+
+    def load(self):
+        """Open the cache mapset and read its index"""
+        env = gscript.gisenv()
+        self.target = env['MAPSET']
+        self.directory = os.path.join(
+            env['GISDBASE'],
+            env['LOCATION_NAME'],
+            self.mapset)
+        self.gisrc = create_mapset(self.mapset)
+        path = os.path.join(self.directory, 'cache.json')
+        if os.path.exists(path):
+            with open(path) as cache_file:
+                try:
+                    self.runs = json.load(cache_file)
+                except ValueError:
+                    gscript.warning(
+                        "Ignoring unreadable cache index {path}".format(
+                            path=path))
+                    self.runs = {}
+
+    def save(self):
+        """Write the index of cached runs"""
+        path = os.path.join(self.directory, 'cache.json')
+        with open(path, 'w') as cache_file:
+            json.dump(self.runs, cache_file, indent=2, sort_keys=True)
+
+    def environment(self):
+        """Return an environment with the cache mapset as current mapset"""
+        env = os.environ.copy()
+        env['GISRC'] = self.gisrc
+        return env
+
+    def lookup(self, inputs, params):
+        """Copy the outputs of an identical earlier run
+        and return their names, or return None if there is none"""
+        with open(os.path.realpath(__file__), 'rb') as source:
+            version = hashlib.sha1(source.read()).hexdigest()
+        self.key = hashlib.sha1(json.dumps(
+            [version,
+             sorted(params.items()),
+             [map_signature(input_map) for input_map in inputs
+              if input_map],
+             sorted(gscript.parse_command('g.region', flags='g').items()),
+             map_signature('MASK')]).encode('utf-8')).hexdigest()
+        run = self.runs.get(self.key)
+        if not run:
+            return None
+        if not all(gscript.find_file(
+                '{name}@{mapset}'.format(name=cached, mapset=self.mapset),
+                element='cell')['name']
+                for output, cached in run['outputs']):
+            self.remove(self.key)
+            self.save()
+            return None
+        gscript.message("Copying outputs of an identical run from cache")
+        for output, cached in run['outputs']:
+            gscript.run_command(
+                'g.copy',
+                raster=['{name}@{mapset}'.format(
+                    name=cached,
+                    mapset=self.mapset), output],
+                overwrite=True,
+                quiet=True)
+        run['used'] = time.time()
+        self.save()
+        return [output for output, cached in run['outputs']]
+
+    def store(self, outputs):
+        """Copy the outputs of a run into the cache mapset
+        and remove the least recently used runs over the size limit"""
+        env = self.environment()
+        run = {'outputs': [], 'size': 0, 'used': time.time()}
+        for output in outputs:
+            cached = 'run_{key}_{name}'.format(key=self.key[:16], name=output)
+            gscript.run_command(
+                'g.copy',
+                raster=['{name}@{mapset}'.format(
+                    name=output,
+                    mapset=self.target), cached],
+                overwrite=True,
+                quiet=True,
+                env=env)
+            run['outputs'].append([output, cached])
+            run['size'] += map_size(self.directory, cached)
+        self.runs[self.key] = run
+        for key in sorted(self.runs, key=lambda key: self.runs[key]['used']):
+            if sum(cached_run['size'] for cached_run
+                   in self.runs.values()) <= self.size:
+                break
+            self.remove(key)
+        self.save()
+
+    def remove(self, key):
+        """Remove the outputs of a cached run"""
+        run = self.runs.pop(key)
+        gscript.run_command(
+            'g.remove',
+            type='raster',
+            name=[cached for output, cached in run['outputs']],
+            flags='f',
+            quiet=True,
+            env=self.environment())
+
+    def clear(self):
+        """Remove all cached runs"""
+        gscript.run_command(
+            'g.remove',
+            type='raster',
+            pattern='run_*',
+            flags='f',
+            quiet=True,
+            env=self.environment())
+        self.runs = {}
+        self.save()
+
+
+cache = Cache()
+
+# intermediate maps removed on exit
+temporary_maps = []
+
+# output maps copied from the scratch mapset and into the cache
+output_maps = []
+
+# minutes in relative time units of rainfall time series
+minutes_per_unit = {
+    'seconds': 1. / 60.,
+    'minutes': 1.,
+    'hours': 60.,
+    'days': 1440.}
+
+# grid steps of the LS factor tables in degrees of slope
+# and in the natural logarithm of flow depth
+slope_step = 0.01
+flow_step = 0.01
+
+# the raster library is not thread safe
+raster_lock = threading.Lock()
+
+
+class RasterStack(object):
+    """Chunked and compressed array store of model outputs
+
+    Each variable is stored as a three dimensional array
+    of scenarios by rows by columns of the current region,
+    chunked into single scenario tiles.
+    Scenarios are appended to an existing store
+    or overwritten if a scenario with the same name exists.
+    """
+
+    variables = ['erosion', 'ls_factor', 'flow_accumulation']
+
+    def __init__(self, path, stack_format, tile):
+        try:
+            import numpy as np
+        except ImportError:
+            gscript.fatal("Array stores require the NumPy library")
+        self.path = path
+        self.stack_format = stack_format
+        self.tile = tile
+        self.lock = threading.Lock()
+        region = gscript.region()
+        self.rows = int(region['rows'])
+        self.cols = int(region['cols'])
+        self.bounds = [region['n'], region['s'], region['e'], region['w']]
+        self.x = region['w'] + (np.arange(self.cols) + 0.5) * region['ewres']
+        self.y = region['n'] - (np.arange(self.rows) + 0.5) * region['nsres']
+        try:
+            self.crs = gscript.read_command('g.proj', flags='wf').strip()
+        except CalledModuleError:
+            self.crs = ''
+        if stack_format == 'zarr':
+            self.open_zarr()
+        else:
+            self.open_netcdf()
+
+    def open_zarr(self):
+        """Open or create a Zarr directory store"""
+        try:
+            import zarr
+        except ImportError:
+            gscript.fatal("Zarr array stores require the zarr library")
+        try:
+            # xarray reads the dimensions of Zarr format 2 arrays
+            # from their _ARRAY_DIMENSIONS attribute
+            self.store = zarr.open_group(self.path, mode='a', zarr_format=2)
+        except TypeError:
+            # zarr 2 only writes Zarr format 2
+            self.store = zarr.open_group(self.path, mode='a')
+        if 'erosion' not in self.store:
+            # zarr 3 creates arrays with create_array
+            # and requires the shape and dtype of new arrays
+            create = (getattr(self.store, 'create_array', None)
+                      or self.store.create_dataset)
+            chunks = (1, min(self.tile, self.rows), min(self.tile, self.cols))
+            for name in self.variables:
+                array = create(
+                    name,
+                    shape=(0, self.rows, self.cols),
+                    chunks=chunks,
+                    dtype='f8',
+                    fill_value=float('nan'))
+                array.attrs['_ARRAY_DIMENSIONS'] = ['scenario', 'y', 'x']
+            for name, values in [('x', self.x), ('y', self.y)]:
+                array = create(name, shape=values.shape, dtype=values.dtype)
+                array[:] = values
+                array.attrs['_ARRAY_DIMENSIONS'] = [name]
+            self.store.attrs['bounds'] = self.bounds
+            self.store.attrs['crs_wkt'] = self.crs
+            self.store.attrs['scenarios'] = []
+        self.check_region(self.store.attrs['bounds'],
+                          self.store['erosion'].shape[1:])
+        self.scenarios = list(self.store.attrs['scenarios'])
+
+    def open_netcdf(self):
+        """Open or create a NetCDF4 file"""
+        try:
+            import netCDF4
+        except ImportError:
+            gscript.fatal("NetCDF array stores require the netCDF4 library")
+        if os.path.exists(self.path):
+            self.store = netCDF4.Dataset(self.path, 'a')
+        else:
+            self.store = netCDF4.Dataset(self.path, 'w')
+            self.store.createDimension('scenario', None)
+            self.store.createDimension('y', self.rows)
+            self.store.createDimension('x', self.cols)
+            self.store.createVariable('scenario', str, ('scenario',))
+            for name, values in [('x', self.x), ('y', self.y)]:
+                variable = self.store.createVariable(name, 'f8', (name,))
+                variable[:] = values
+            for name in self.variables:
+                self.store.createVariable(
+                    name, 'f8', ('scenario', 'y', 'x'),
+                    zlib=True,
+                    complevel=4,
+                    chunksizes=(1,
+                                min(self.tile, self.rows),
+                                min(self.tile, self.cols)),
+                    fill_value=float('nan'))
+            self.store.bounds = self.bounds
+            self.store.crs_wkt = self.crs
+        self.check_region(list(self.store.bounds),
+                          (len(self.store.dimensions['y']),
+                           len(self.store.dimensions['x'])))
+        self.scenarios = list(self.store.variables['scenario'][:])
+
+    def check_region(self, bounds, shape):
+        """Stop if the store does not match the current region"""
+        if (list(bounds) != self.bounds
+                or tuple(shape) != (self.rows, self.cols)):
+            gscript.fatal(
+                "Array store {path} does not match the current region".format(
+                    path=self.path))
+
+    def scenario(self, name):
+        """Return the index of a scenario, appending it if it is new"""
+        with self.lock:
+            if name in self.scenarios:
+                return self.scenarios.index(name)
+            self.scenarios.append(name)
+            index = len(self.scenarios) - 1
+            if self.stack_format == 'zarr':
+                for variable in self.variables:
+                    self.store[variable].resize(
+                        (len(self.scenarios), self.rows, self.cols))
+                self.store.attrs['scenarios'] = self.scenarios
+            else:
+                self.store.variables['scenario'][index] = name
+            return index
+
+    def write(self, variable, index, start, block):
+        """Write a block of rows of a scenario"""
+        with self.lock:
+            if self.stack_format == 'zarr':
+                self.store[variable][index, start:start + len(block)] = block
+            else:
+                self.store.variables[variable][
+                    index, start:start + len(block), :] = block
+
+    def write_map(self, variable, index, name):
+        """Write a raster map as a scenario in blocks of chunk rows"""
+        with raster_lock:
+            raster = open_raster(name)
+            try:
+                for start in range(0, self.rows, self.tile):
+                    stop = min(start + self.tile, self.rows)
+                    self.write(variable, index, start,
+                               read_rows(raster, start, stop, self.cols))
+            finally:
+                raster.close()
+
+    def close(self):
+        """Close the store"""
+        if self.stack_format == 'netcdf':
+            self.store.close()
+
+
 def main():
     options, flags = gscript.parser()
     elevation = options['elevation']
@@ -205,6 +1060,7 @@ def main():
     ls_factor = options['ls_factor']
     rain_intensity = options['rain_intensity']
     rain_duration = options['rain_duration']
+    rainfall = options['rainfall']
     r_factor = options['r_factor']
     k_factor = options['k_factor']
     c_factor = options['c_factor']
@@ -213,42 +1069,504 @@ def main():
     c_factor_value = options['c_factor_value']
     m_coeff = options['m_coeff']
     n_coeff = options['n_coeff']
+    members = options['members']
+    erosion_mean = options['erosion_mean']
+    erosion_stddev = options['erosion_stddev']
+    erosion_percentile = options['erosion_percentile']
+    percentiles = options['percentiles']
+    memory = options['memory']
+    scenario = options['scenario'] or erosion
+
+    # invalidate the cache of outputs of identical runs
+    if flags['i']:
+        cache.load()
+        cache.clear()
+        sys.exit(0)
+
+    # check ensemble parameters
+    if members:
+        if model != "rusle":
+            gscript.fatal(
+                "Ensembles are only supported by the RUSLE3D model")
+        if not (erosion_mean or erosion_stddev or erosion_percentile):
+            gscript.fatal(
+                "Ensembles require erosion_mean, erosion_stddev "
+                "or erosion_percentile output")
+        if bool(percentiles) != bool(erosion_percentile):
+            gscript.fatal(
+                "Options percentiles and erosion_percentile "
+                "must be used together")
+
+    # estimate costs without computing
+    elevations = elevation.split(',')
+    nprocs = int(options['nprocs'])
+
+    # check the time series of elevation maps
+    names = [name.split('@')[0] for name in elevations]
+    if len(set(names)) < len(names):
+        gscript.fatal(
+            "Elevation maps of a time series must have unique names "
+            "without their mapsets")
+    if options['erosion_difference'] and len(elevations) < 2:
+        gscript.warning(
+            "Differences in erosion require a time series "
+            "of elevation maps")
+    if flags['e']:
+        shared_stages = []
+        if rainfall:
+            steps = gscript.parse_command(
+                't.info', input=rainfall, flags='g')['number_of_maps']
+            shared_stages.append(('space_time_r_factor', int(steps)))
+        elif rain_intensity:
+            shared_stages.append(('event_r_factor', 1))
+        elif not r_factor:
+            shared_stages.append(('r_factor', 1))
+        if not k_factor:
+            shared_stages.append(('k_factor', 1))
+        if not c_factor:
+            shared_stages.append(('c_factor', 1))
+        if model == "rusle":
+            epoch_stages = [('slope', 1), ('flow_accumulation', 1)]
+            if ls_factor:
+                epoch_stages.append(('rusle_ls_factor', 1))
+            epoch_stages.append(('rusle_erosion', 1))
+            if members:
+                epoch_stages.append(('rusle_ensemble', int(members)))
+        else:
+            epoch_stages = [('slope_aspect', 1), ('flow_accumulation', 1)]
+            if ls_factor:
+                epoch_stages.append(('usped_ls_factor', 1))
+            epoch_stages.extend(
+                [('sediment_flow', 1),
+                 ('divergence', 1),
+                 ('erosion_deposition', 1)])
+        outputs = len([output for output in [
+            erosion, flow_accumulation, ls_factor,
+            erosion_mean, erosion_stddev] if output])
+        outputs += len([percentile for percentile in percentiles.split(',')
+                        if percentile])
+        estimate(shared_stages, epoch_stages, len(elevations), nprocs,
+                 outputs, int(memory))
+        sys.exit(0)
+
+    # query erosion at points or in areas of interest
+    if options['coordinates'] or options['aoi']:
+        if model != "rusle":
+            gscript.fatal("Queries are only supported by the RUSLE3D model")
+        if len(elevations) > 1:
+            gscript.fatal("Queries require a single elevation map")
+        if (rainfall or rain_intensity) and not r_factor:
+            gscript.fatal("Queries require an R factor map or value")
+
+        # keep slope and flow accumulation for later queries
+        checkpoint.load()
+        query(elevation,
+              options['coordinates'],
+              options['aoi'],
+              options['table'],
+              factors=[(r_factor, r_factor_value),
+                       (k_factor, k_factor_value),
+                       (c_factor, c_factor_value)],
+              m_coeff=m_coeff,
+              n_coeff=n_coeff,
+              memory=int(memory))
+        sys.exit(0)
+
+    # export outputs as they are written
+    if options['export']:
+        if not os.path.exists(options['export']):
+            os.makedirs(options['export'])
+        exporter.directory = options['export']
+
+    # reuse the outputs of an identical earlier run
+    if (options['cache_size']
+            and not options['stack']
+            and not (members and not options['seed'])):
+        cache.size = float(options['cache_size']) * 1024 ** 2
+        cache.load()
+        inputs = elevations + [r_factor, k_factor, c_factor]
+        if rainfall:
+            inputs.extend(gscript.read_command(
+                't.rast.list',
+                input=rainfall,
+                columns='id',
+                flags='u').split())
+        params = {key: value for key, value in options.items()
+                  if key not in ['memory', 'nprocs', 'export', 'scratch',
+                                 'cache_size', 'stack', 'stack_format',
+                                 'scenario', 'tile', 'coordinates', 'aoi',
+                                 'table']}
+        # flags that change the outputs
+        params['flags'] = [flag for flag in ['f'] if flags[flag]]
+        outputs = cache.lookup(inputs, params)
+        if outputs is not None:
+            for output in outputs:
+                exporter.export(output)
+            sys.exit(0)
+
+    # compute intermediate maps in a scratch mapset
+    if options['scratch']:
+        if rainfall:
+            # find the rainfall time series in the search path
+            # of the target mapset before switching mapsets
+            rainfall = gscript.parse_command(
+                't.info',
+                input=rainfall,
+                flags='g')['id']
+        scratch.create(options['scratch'], keep=flags['c'])
+
+    # keep intermediate maps and resume from completed stages
+    if flags['c']:
+        checkpoint.load()
+    atexit.register(cleanup)
+
+    # open array store for model outputs
+    stack = None
+    if options['stack']:
+        stack = RasterStack(
+            options['stack'],
+            options['stack_format'],
+            int(options['tile']))
 
     # check for alternative input parameters
-    if not rain_intensity:
+    if rainfall:
+        # compute erosivity (R) factor from a rainfall time series
+        r_factor = space_time_r_factor(rainfall, rain_duration, int(memory))
+    elif not rain_intensity:
         if not r_factor:
             r_factor = 'r_factor'
-            gscript.run_command(
-                'r.mapcalc',
-                expression="r_factor = {r_factor_value}".format(**locals()),
-                overwrite=True)
+            if checkpoint.start('r_factor', inputs=[], outputs=[r_factor],
+                                params=[r_factor_value]):
+                gscript.run_command(
+                    'r.mapcalc',
+                    expression="r_factor = {r_factor_value}".format(
+                        **locals()),
+                    overwrite=True)
+                checkpoint.finish('r_factor')
     else:
         # compute event-based erosivity (R) factor (MJ mm ha^-1 hr^-1 yr^-1)
         r_factor = event_based_r_factor(rain_intensity, rain_duration)
     if not c_factor:
         c_factor = 'c_factor'
-        gscript.run_command(
-            'r.mapcalc',
-            expression="c_factor = {c_factor_value}".format(**locals()),
-            overwrite=True)
+        if checkpoint.start('c_factor', inputs=[], outputs=[c_factor],
+                            params=[c_factor_value]):
+            gscript.run_command(
+                'r.mapcalc',
+                expression="c_factor = {c_factor_value}".format(**locals()),
+                overwrite=True)
+            checkpoint.finish('c_factor')
     if not k_factor:
         k_factor = 'k_factor'
-        gscript.run_command(
-            'r.mapcalc',
-            expression="k_factor = {k_factor_value}".format(**locals()),
-            overwrite=True)
-
-    # determine type of model and run
-    if model == "rusle":
-        rusle(elevation, erosion, flow_accumulation, r_factor,
-              c_factor, k_factor, ls_factor, m_coeff, n_coeff)
-    if model == "usped":
-        usped(elevation, erosion, flow_accumulation, r_factor,
-              c_factor, k_factor, ls_factor, m_coeff, n_coeff)
-    atexit.register(cleanup)
+        if checkpoint.start('k_factor', inputs=[], outputs=[k_factor],
+                            params=[k_factor_value]):
+            gscript.run_command(
+                'r.mapcalc',
+                expression="k_factor = {k_factor_value}".format(**locals()),
+                overwrite=True)
+            checkpoint.finish('k_factor')
+
+    # run the model for each epoch of a time series of elevation models
+    epochs = [None]
+    if len(elevations) > 1:
+        epochs = [name.split('@')[0] for name in elevations]
+    epoch_memory = int(memory) // max(1, min(nprocs, len(epochs)))
+
+    def run_epoch(epoch):
+        """Run the model for an elevation model with shared factor maps"""
+        elevation = elevations[epochs.index(epoch)]
+        suffix = '_' + epoch if epoch else ''
+        outputs = [epoch_name(output, epoch)
+                   for output in [erosion, flow_accumulation, ls_factor]
+                   if output]
+
+        # determine type of model and run
+        if model == "rusle":
+            rusle(elevation,
+                  epoch_name(erosion, epoch),
+                  epoch_name(flow_accumulation, epoch),
+                  r_factor, c_factor, k_factor,
+                  epoch_name(ls_factor, epoch),
+                  m_coeff, n_coeff, suffix, epoch_memory)
+            if members:
+                with raster_lock:
+                    outputs += rusle_ensemble(
+                        'slope' + suffix, 'flowacc' + suffix,
+                        factors=[r_factor, k_factor, c_factor],
+                        factor_stddevs=[float(options['r_factor_stddev']),
+                                        float(options['k_factor_stddev']),
+                                        float(options['c_factor_stddev'])],
+                        coeffs=[float(m_coeff), float(n_coeff)],
+                        coeff_stddevs=[float(options['m_coeff_stddev']),
+                                       float(options['n_coeff_stddev'])],
+                        members=int(members),
+                        seed=int(options['seed']) if options['seed'] else None,
+                        batch=int(options['batch']),
+                        memory=epoch_memory,
+                        erosion_mean=epoch_name(erosion_mean, epoch),
+                        erosion_stddev=epoch_name(erosion_stddev, epoch),
+                        erosion_percentile=epoch_name(
+                            erosion_percentile, epoch),
+                        percentiles=[float(percentile) for percentile
+                                     in percentiles.split(',') if percentile],
+                        stack=stack,
+                        scenario=epoch_name(scenario, epoch),
+                        suffix=suffix,
+                        fast=flags['f'])
+        if model == "usped":
+            usped(elevation,
+                  epoch_name(erosion, epoch),
+                  epoch_name(flow_accumulation, epoch),
+                  r_factor, c_factor, k_factor,
+                  epoch_name(ls_factor, epoch),
+                  m_coeff, n_coeff, suffix, epoch_memory)
+
+        # export model outputs, including outputs of resumed stages,
+        # and copy them into the target mapset
+        for output in outputs:
+            exporter.export(output)
+            output_maps.append(output)
+
+        # write model outputs to array store
+        if stack:
+            index = stack.scenario(epoch_name(scenario, epoch))
+            stack.write_map('erosion', index, epoch_name(erosion, epoch))
+            if ls_factor:
+                stack.write_map('ls_factor', index,
+                                epoch_name(ls_factor, epoch))
+            if flow_accumulation:
+                stack.write_map('flow_accumulation', index,
+                                epoch_name(flow_accumulation, epoch))
+
+    def run_pool_epoch(epoch):
+        """Run an epoch in a worker thread and keep the exit of a fatal error,
+        which would end the worker and block the pool"""
+        try:
+            run_epoch(epoch)
+        except SystemExit as error:
+            exits.append(error)
+
+    # run epochs in parallel
+    nprocs = min(nprocs, len(epochs))
+    if nprocs > 1:
+        exits = []
+        pool = ThreadPool(nprocs)
+        try:
+            pool.map(run_pool_epoch, epochs)
+        finally:
+            pool.close()
+            pool.join()
+        if exits:
+            raise exits[0]
+    else:
+        for epoch in epochs:
+            run_epoch(epoch)
+    if stack:
+        stack.close()
+
+    # compute difference in erosion between consecutive epochs
+    if options['erosion_difference'] and len(epochs) > 1:
+        for earlier, later in zip(epochs, epochs[1:]):
+            difference = "{basename}_{later}_{earlier}".format(
+                basename=options['erosion_difference'],
+                later=later,
+                earlier=earlier)
+            gscript.run_command(
+                'r.mapcalc',
+                expression="{difference}={later}-{earlier}".format(
+                    difference=difference,
+                    later=epoch_name(erosion, later),
+                    earlier=epoch_name(erosion, earlier)),
+                overwrite=True)
+            gscript.write_command(
+                'r.colors',
+                map=difference,
+                rules='-',
+                stdin=erosion_colors)
+            exporter.export(difference)
+            output_maps.append(difference)
+
+    # copy output maps into the target mapset
+    scratch.finish(output_maps)
+
+    # store output maps for identical runs
+    if cache.key:
+        cache.store(output_maps)
+
+    # calibrate the costs of stages
+    if flags['t']:
+        calibrate(checkpoint.timings)
     sys.exit(0)
 
 
+def epoch_name(name, epoch):
+    """Name an output map after the epoch of its elevation model"""
+    if not name or not epoch:
+        return name
+    return "{name}_{epoch}".format(name=name, epoch=epoch)
+
+
+def stage_cost(name):
+    """Return the base name of a stage of an epoch with its default costs"""
+    for stage in sorted(stage_costs, key=len, reverse=True):
+        if name == stage or name.startswith(stage + '_'):
+            return stage, stage_costs[stage]
+    return None, None
+
+
+def load_costs():
+    """Read calibrated seconds per cell of each stage"""
+    path = os.path.join(module_directory(), 'costs.json')
+    if os.path.exists(path):
+        with open(path) as costs_file:
+            try:
+                return json.load(costs_file)
+            except ValueError:
+                pass
+    return {}
+
+
+def count_cells():
+    """Return the number of cells in the region and outside the mask"""
+    cells = int(gscript.parse_command('g.region', flags='g')['cells'])
+    masked_cells = cells
+    if gscript.find_file('MASK', element='cell')['file']:
+        masked_cells = int(gscript.parse_command(
+            'r.univar', map='MASK', flags='g')['n'])
+    return cells, masked_cells
+
+
+def stage_cells(stage, cells, masked_cells):
+    """Return the number of cells that the runtime of a stage scales with"""
+    if stage == 'flow_accumulation':
+        # r.watershed skips masked cells
+        return masked_cells
+    return cells
+
+
+def calibrate(timings):
+    """Update the seconds per cell of each stage from the timing of a run
+    as an exponential moving average"""
+    cells, masked_cells = count_cells()
+    costs = load_costs()
+    for name, seconds in timings.items():
+        stage, _ = stage_cost(name)
+        if not stage or stage in ['rusle_ensemble', 'space_time_r_factor']:
+            continue
+        measured = seconds / float(stage_cells(stage, cells, masked_cells))
+        if stage in costs:
+            measured = 0.5 * costs[stage] + 0.5 * measured
+        costs[stage] = measured
+    path = os.path.join(module_directory(), 'costs.json')
+    with open(path, 'w') as costs_file:
+        json.dump(costs, costs_file, indent=2, sort_keys=True)
+
+
+def estimate(shared_stages, epoch_stages, epochs, nprocs, outputs, memory):
+    """Print the predicted runtime, peak memory and disk space of a run
+    without computing it
+
+    Stages are given as lists of stage names and repetitions,
+    i.e. ensemble members or time steps.
+    Shared stages run once and the stages of each epoch
+    run in up to nprocs parallel workers sharing memory."""
+    cells, masked_cells = count_cells()
+    workers = max(1, min(nprocs, epochs))
+    memory_share = memory * 1024 ** 2 // workers
+    costs = load_costs()
+    megabyte = 1024. ** 2
+
+    print("cells={cells}".format(cells=cells))
+    print("masked_cells={cells}".format(cells=masked_cells))
+    runtime = 0.
+    peak_memory = 0.
+    temporary_disk = 0.
+    for stages, scale in [(shared_stages, 1), (epoch_stages, epochs)]:
+        for name, repeat in stages:
+            seconds, memory_bytes, disk_bytes = stage_costs[name]
+            seconds = costs.get(name, seconds) * repeat
+            stage_memory = cells * memory_bytes
+            if name == 'rusle_ensemble':
+                stage_memory = cells * 8 * (7 + 4 * min(repeat, 10))
+            if name in ['rusle_ensemble', 'flow_accumulation',
+                        'space_time_r_factor']:
+                # bounded by the memory option
+                stage_memory = min(stage_memory, memory_share)
+            stage_runtime = stage_cells(name, cells, masked_cells) * seconds
+            if scale > 1:
+                stage_runtime *= float(scale) / workers
+                stage_memory *= workers
+            runtime += stage_runtime
+            peak_memory = max(peak_memory, stage_memory)
+            temporary_disk += cells * disk_bytes * scale
+            print("{name}_seconds={seconds:.1f}".format(
+                name=name, seconds=stage_runtime))
+            print("{name}_memory_mb={memory:.1f}".format(
+                name=name, memory=stage_memory / megabyte))
+
+    # recommend segmentation and tiling for r.watershed
+    watershed_memory = cells * stage_costs['flow_accumulation'][1]
+    segmented = watershed_memory > memory_share
+    print("runtime_seconds={runtime:.1f}".format(runtime=runtime))
+    print("peak_memory_mb={memory:.1f}".format(
+        memory=peak_memory / megabyte))
+    print("temporary_disk_mb={disk:.1f}".format(
+        disk=temporary_disk / megabyte))
+    print("output_disk_mb={disk:.1f}".format(
+        disk=cells * 8. * outputs * epochs / megabyte))
+    print("watershed_segmented={segmented}".format(
+        segmented=int(segmented)))
+    print("recommended_memory={memory}".format(
+        memory=int(math.ceil(watershed_memory * workers / megabyte))))
+    print("recommended_nprocs={nprocs}".format(
+        nprocs=max(1, min(epochs, int(
+            memory * megabyte // max(watershed_memory, 1))))))
+    print("recommended_tile_cells={tile}".format(
+        tile=int(math.sqrt(memory_share
+                           / stage_costs['flow_accumulation'][1]))))
+
+
+def module_directory():
+    """Return the directory for checkpoints and costs in the mapset"""
+    env = gscript.gisenv()
+    directory = os.path.join(
+        env['GISDBASE'],
+        env['LOCATION_NAME'],
+        env['MAPSET'],
+        'r.erosion')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def map_size(directory, name):
+    """Return the size in bytes of the files of a raster map in a mapset"""
+    size = 0
+    for element in ['cell', 'fcell', 'cellhd', 'colr', 'cats', 'hist',
+                    'cell_misc']:
+        path = os.path.join(directory, element, name)
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for root, directories, files in os.walk(path):
+                size += sum(os.path.getsize(os.path.join(root, file_name))
+                            for file_name in files)
+    return size
+
+
+def map_signature(name):
+    """Identify a raster map by its full name and file modification times"""
+    found = gscript.find_file(name, element='cell')
+    if not found['file']:
+        return None
+    mapset_path = os.path.dirname(os.path.dirname(found['file']))
+    times = []
+    for element in ['cellhd', 'cell', 'fcell']:
+        path = os.path.join(mapset_path, element, found['name'])
+        if os.path.exists(path):
+            times.append(os.path.getmtime(path))
+    return [found['fullname'], times]
+
+
 def event_based_r_factor(rain_intensity, rain_duration):
     """compute event-based erosivity (R) factor (MJ mm ha^-1 hr^-1 yr^-1)"""
 
@@ -257,6 +1575,11 @@ def event_based_r_factor(rain_intensity, rain_duration):
     rain_volume = 'rain_volume'
     erosivity = 'erosivity'
     r_factor = 'r_factor'
+    temporary_maps.extend([rain_energy, rain_volume, erosivity])
+
+    if not checkpoint.start('event_r_factor', inputs=[], outputs=[r_factor],
+                            params=[rain_intensity, rain_duration]):
+        return r_factor
 
     # derive rainfall energy (MJ ha^-1 mm^-1)
     gscript.run_command(
@@ -344,77 +1667,229 @@ def event_based_r_factor(rain_intensity, rain_duration):
               'erosivity'],
         flags='f')
 
+    checkpoint.finish('event_r_factor')
     return r_factor
 
 
-def rusle(elevation, erosion, flow_accumulation, r_factor,
-          c_factor, k_factor, ls_factor, m_coeff, n_coeff):
-    """The RUSLE3D
-    (Revised Universal Soil Loss Equation for Complex Terrain) model
-    for detachment limited soil erosion regimes"""
+def space_time_r_factor(rainfall, rain_duration, memory):
+    """compute event-based erosivity (R) factor (MJ mm ha^-1 hr^-1 yr^-1)
+    from a space time raster dataset of rainfall intensity in mm/hr
+
+    The event erosivity index is accumulated over the time steps
+    in a single pass over blocks of rows
+    without writing maps for each time step."""
+    try:
+        import numpy as np
+        import grass.temporal as tgis
+        from grass.pygrass.gis.region import Region
+    except ImportError:
+        gscript.fatal("Rainfall time series require the NumPy library")
 
     # assign variables
-    slope = 'slope'
-    grow_slope = 'grow_slope'
-    flowacc = 'flowacc'
-    sedflow = 'sedflow'
+    r_factor = 'r_factor'
 
-    # compute slope
-    gscript.run_command(
-        'r.slope.aspect',
-        elevation=elevation,
-        slope=slope,
-        overwrite=True)
+    # list time steps and their duration in minutes
+    tgis.init()
+    dataset = tgis.open_old_stds(rainfall, 'strds')
+    steps = []
+    for raster in dataset.get_registered_maps_as_objects(
+            order='start_time'):
+        start, end = raster.get_temporal_extent_as_tuple()
+        if end is None:
+            if not rain_duration:
+                gscript.fatal(
+                    "Rainfall time series without time intervals "
+                    "require the duration of each time step "
+                    "as rain_duration")
+            duration = float(rain_duration)
+        elif raster.is_time_absolute():
+            duration = (end - start).total_seconds() / 60.
+        else:
+            unit = raster.get_relative_time_unit()
+            if unit not in minutes_per_unit:
+                gscript.fatal(
+                    "Rainfall time series with relative time in {unit} "
+                    "are not supported; use seconds, minutes, hours "
+                    "or days".format(unit=unit))
+            duration = (end - start) * minutes_per_unit[unit]
+        steps.append((raster.get_id(), duration))
+    if not steps:
+        gscript.fatal(
+            "Space time raster dataset {rainfall} is empty".format(
+                rainfall=rainfall))
+    total_duration = sum(duration for name, duration in steps)
+
+    if not checkpoint.start('space_time_r_factor',
+                            inputs=[name for name, duration in steps],
+                            outputs=[r_factor],
+                            params=steps):
+        return r_factor
+
+    # fit blocks of rows into memory
+    region = Region()
+    rows, cols = region.rows, region.cols
+    block_rows = max(1, min(rows, memory * 1024 * 1024 // (cols * 8 * 4)))
+
+    output = create_raster(r_factor)
+    try:
+        for start in range(0, rows, block_rows):
+            stop = min(start + block_rows, rows)
+            gscript.percent(start, rows, 1)
+            erosivity = np.zeros((stop - start, cols))
+            for name, duration in steps:
+                raster = open_raster(name)
+                try:
+                    rain_intensity = read_rows(raster, start, stop, cols)
+                finally:
+                    raster.close()
+
+                # null cells have no rainfall
+                rain_intensity = np.nan_to_num(rain_intensity)
+
+                # derive rainfall energy (MJ ha^-1 mm^-1)
+                rain_energy = 0.29 * (
+                    1. - (0.72 * np.exp(-0.05 * rain_intensity)))
+
+                # derive rainfall volume (mm)
+                rain_volume = rain_intensity * (duration / 60.)
+
+                # accumulate event erosivity index (MJ mm ha^-1 hr^-1)
+                erosivity += rain_energy * rain_volume * rain_intensity
+
+            # derive R factor (MJ mm ha^-1 hr^-1 yr^-1)
+            write_rows(output, erosivity / (total_duration / 525600.))
+        gscript.percent(rows, rows, 1)
+    finally:
+        output.close()
+
+    checkpoint.finish('space_time_r_factor')
+    return r_factor
 
-    # grow border to fix edge effects of moving window computations
-    gscript.run_command(
-        'r.grow.distance',
-        input=slope,
-        value=grow_slope,
-        overwrite=True)
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{slope}={grow_slope}".format(
+
+def compute_slope(elevation, slope, grow_slope, suffix=''):
+    """Compute slope with r.slope.aspect and grow its border"""
+
+    if checkpoint.start('slope' + suffix, inputs=[elevation],
+                        outputs=[slope, grow_slope]):
+        gscript.run_command(
+            'r.slope.aspect',
+            elevation=elevation,
             slope=slope,
-            grow_slope=grow_slope),
-        overwrite=True)
+            overwrite=True)
+
+        # grow border to fix edge effects of moving window computations
+        gscript.run_command(
+            'r.grow.distance',
+            input=slope,
+            value=grow_slope,
+            overwrite=True)
+        gscript.run_command(
+            'r.mapcalc',
+            expression="{slope}={grow_slope}".format(
+                slope=slope,
+                grow_slope=grow_slope),
+            overwrite=True)
+        checkpoint.finish('slope' + suffix)
+
+
+def compute_flow_accumulation(elevation, flowacc, flow_accumulation,
+                              suffix='', memory=300):
+    """Compute flow accumulation with r.watershed and return
+    the flow depth map, or its expression if no output map is requested
+
+    r.watershed runs in segmented mode if it does not fit into memory"""
 
-    # compute flow accumulation
-    gscript.run_command(
-        'r.watershed',
-        elevation=elevation,
-        accumulation=flowacc,
-        flags="a",
-        overwrite=True)
     region = gscript.parse_command(
         'g.region', flags='g')
     res = region['nsres']
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{depth}"
-        "=({flowacc}*{res})".format(
-            depth=flow_accumulation,
-            flowacc=flowacc,
-            res=res),
-        overwrite=True)
-    gscript.run_command(
-        'r.colors',
-        map=flow_accumulation,
-        raster=flowacc)
+    depth = "({flowacc}*{res})".format(
+        flowacc=flowacc,
+        res=res)
+    outputs = [flowacc]
+    if flow_accumulation:
+        outputs.append(flow_accumulation)
+    if checkpoint.start('flow_accumulation' + suffix, inputs=[elevation],
+                        outputs=outputs):
+        flags = "a"
+        if (int(region['cells']) * stage_costs['flow_accumulation'][1]
+                > memory * 1024 ** 2):
+            flags += "m"
+        gscript.run_command(
+            'r.watershed',
+            elevation=elevation,
+            accumulation=flowacc,
+            flags=flags,
+            memory=memory,
+            overwrite=True)
+        if flow_accumulation:
+            gscript.run_command(
+                'r.mapcalc',
+                expression="{flow_accumulation}={depth}".format(
+                    flow_accumulation=flow_accumulation,
+                    depth=depth),
+                overwrite=True)
+            gscript.run_command(
+                'r.colors',
+                map=flow_accumulation,
+                raster=flowacc)
+        checkpoint.finish('flow_accumulation' + suffix)
+    if flow_accumulation:
+        return flow_accumulation
+    return depth
+
+
+def rusle(elevation, erosion, flow_accumulation, r_factor,
+          c_factor, k_factor, ls_factor, m_coeff, n_coeff, suffix='',
+          memory=300):
+    """The RUSLE3D
+    (Revised Universal Soil Loss Equation for Complex Terrain) model
+    for detachment limited soil erosion regimes
+
+    Flow accumulation and LS factor maps are only written if requested,
+    otherwise their expressions are evaluated within the erosion
+    expression"""
+
+    # assign variables
+    slope = 'slope' + suffix
+    grow_slope = 'grow_slope' + suffix
+    flowacc = 'flowacc' + suffix
+    temporary_maps.extend([slope, grow_slope, flowacc])
+
+    # compute slope
+    compute_slope(elevation, slope, grow_slope, suffix)
+
+    # compute flow accumulation
+    depth = compute_flow_accumulation(elevation, flowacc, flow_accumulation,
+                                      suffix, memory)
 
     # compute dimensionless topographic factor
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{ls_factor}"
-        "=({m}+1.0)"
+    ls = (
+        "({m}+1.0)"
         "*(({flowacc}/22.1)^{m})"
         "*((sin({slope})/5.14)^{n})".format(
-            ls_factor=ls_factor,
             m=m_coeff,
-            flowacc=flow_accumulation,
+            flowacc=depth,
             slope=slope,
-            n=n_coeff),
-        overwrite=True)
+            n=n_coeff))
+    if ls_factor:
+        expression = "{ls_factor}={ls}".format(
+            ls_factor=ls_factor,
+            ls=ls)
+        if checkpoint.start('rusle_ls_factor' + suffix,
+                            inputs=[flowacc, slope, flow_accumulation],
+                            outputs=[ls_factor],
+                            params=[expression]):
+            gscript.run_command(
+                'r.mapcalc',
+                expression=expression,
+                overwrite=True)
+            gscript.write_command(
+                'r.colors',
+                map=ls_factor,
+                rules='-',
+                stdin=lsfactor_colors)
+            checkpoint.finish('rusle_ls_factor' + suffix)
+        ls = ls_factor
 
     # compute sediment flow
     """E = R * K * LS * C * P
@@ -426,19 +1901,6 @@ def rusle(elevation, erosion, flow_accumulation, r_factor,
     C is a dimensionless land cover factor
     P is a dimensionless prevention measures factor
     """
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{sedflow}"
-        "={r_factor}"
-        "*{k_factor}"
-        "*{ls_factor}"
-        "*{c_factor}".format(
-            sedflow=sedflow,
-            r_factor=r_factor,
-            k_factor=k_factor,
-            ls_factor=ls_factor,
-            c_factor=c_factor),
-        overwrite=True)
 
     # # convert sediment flow from tons*ha^-1*s^-1 to kg*m^-2^s^-1
     # gscript.run_command(
@@ -452,130 +1914,563 @@ def rusle(elevation, erosion, flow_accumulation, r_factor,
     #     overwrite=True)
 
     # convert sediment flow from tons/ha/yr to kg/m^2s
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{converted_sedflow}"
-        "={sedflow}"
+    expression = (
+        "{converted_sedflow}"
+        "={r_factor}"
+        "*{k_factor}"
+        "*({ls_factor})"
+        "*{c_factor}"
         "*{ton_to_kg}"
         "/{ha_to_m2}"
         "/{yr_to_s}".format(
             converted_sedflow=erosion,
-            sedflow=sedflow,
+            r_factor=r_factor,
+            k_factor=k_factor,
+            ls_factor=ls,
+            c_factor=c_factor,
             ton_to_kg=1000.,
             ha_to_m2=10000.,
-            yr_to_s=31557600.),
-        overwrite=True)
-
-    # set color tables
-    gscript.write_command(
-        'r.colors',
-        map=ls_factor,
-        rules='-',
-        stdin=lsfactor_colors)
-    gscript.write_command(
-        'r.colors',
-        map=erosion,
-        rules='-',
-        stdin=sedflux_colors)
+            yr_to_s=31557600.))
+    if checkpoint.start('rusle_erosion' + suffix,
+                        inputs=[r_factor, k_factor, c_factor, flowacc, slope,
+                                flow_accumulation, ls_factor],
+                        outputs=[erosion],
+                        params=[expression]):
+        gscript.run_command(
+            'r.mapcalc',
+            expression=expression,
+            overwrite=True)
 
-    # remove temporary maps
-    gscript.run_command(
-        'g.remove',
-        type='raster',
-        name=['slope',
-              'grow_slope',
-              'flowacc',
-              'sedflow'],
-        flags='f')
+        # set color tables
+        gscript.write_command(
+            'r.colors',
+            map=erosion,
+            rules='-',
+            stdin=sedflux_colors)
+        checkpoint.finish('rusle_erosion' + suffix)
+
+
+def rusle_ensemble(slope, flowacc, factors, factor_stddevs,
+                   coeffs, coeff_stddevs, members, seed, batch, memory,
+                   erosion_mean, erosion_stddev, erosion_percentile,
+                   percentiles, stack=None, scenario=None, suffix='',
+                   fast=False):
+    """Monte Carlo ensemble of the RUSLE3D model
+
+    The R, K and C factor maps are shifted and the m and n coefficients
+    are sampled from normal distributions for each member.
+    Members are evaluated in vectorized batches over blocks of rows
+    from the slope and flow accumulation maps computed once,
+    and per-cell statistics are accumulated with Welford's algorithm
+    so that the erosion maps of the members are never stored.
+    If an array store is given, the erosion and LS factor of each member
+    are written to it as scenarios.
+    In fast mode the slope and flow terms of the LS factor
+    are interpolated from tables of each member
+    instead of evaluating sin and pow for every cell."""
+    try:
+        import numpy as np
+        from grass.pygrass.gis.region import Region
+    except ImportError:
+        gscript.fatal("Ensembles require the NumPy library")
+
+    # outputs
+    percentile_maps = [
+        "{base}_{percentile}".format(
+            base=erosion_percentile,
+            percentile="{0:g}".format(percentile).replace('.', '_'))
+        for percentile in percentiles]
+    outputs = [output for output in [erosion_mean, erosion_stddev]
+               if output] + percentile_maps
+    if not checkpoint.start('rusle_ensemble' + suffix,
+                            inputs=[slope, flowacc] + factors,
+                            outputs=outputs,
+                            params=[factor_stddevs, coeffs, coeff_stddevs,
+                                    members, seed, percentiles,
+                                    stack.path if stack else None, fast]):
+        return outputs
+
+    # sample ensemble members
+    random = np.random.RandomState(seed)
+    shifts = [random.normal(0.0, stddev, members)
+              for stddev in factor_stddevs]
+    m_coeffs, n_coeffs = [random.normal(coeff, stddev, members)
+                          for coeff, stddev in zip(coeffs, coeff_stddevs)]
+
+    # tabulate the slope and flow terms of the LS factor of each member
+    region = Region()
+    rows, cols = region.rows, region.cols
+    budget = memory * 1024 * 1024
+    batch = max(1, min(batch, members))
+    arrays = 7 + 4 * batch + (members if percentiles else 0) + (
+        4 if fast else 0)
+    if fast:
+        # slope (degrees) and log of flow depth from 0.01 cells to the region
+        slope_grid = (0.0, slope_step)
+        flow_grid = (math.log(0.01 * region.nsres / 22.1), flow_step)
+        slope_values = np.arange(0.0, 90.0 + slope_step, slope_step)
+        flow_values = np.arange(
+            flow_grid[0],
+            math.log(rows * cols * region.nsres / 22.1) + 2 * flow_step,
+            flow_step)
+
+        # values and differences of the tables of all members
+        # and a row of each block array have to fit into memory
+        table_bytes = members * (slope_values.size + flow_values.size) * 16
+        if table_bytes + cols * 8 * arrays > budget:
+            gscript.fatal(
+                "LS factor tables of {members} members need {tables} MB "
+                "of memory; increase memory or run without the -f flag".format(
+                    members=members,
+                    tables=table_bytes // 1024 ** 2 + 1))
+        budget -= table_bytes
+        slope_table = power_table(
+            np.sin(np.radians(slope_values)) / 5.14, n_coeffs)
+        flow_table = power_table(np.exp(flow_values), m_coeffs)
+
+        # measure the error at the grid midpoints in batches of members
+        if gscript.verbosity() >= 3:
+            slope_error = flow_error = 0.0
+            for first in range(0, members, batch):
+                select = slice(first, first + batch)
+                slope_error = max(slope_error, table_error(
+                    (slope_table[0][select], slope_table[1][select]),
+                    np.sin(np.radians(slope_values[:-1] + slope_step / 2))
+                    / 5.14,
+                    n_coeffs[select],
+                    slope_values[:-1] >= 1.0))
+                flow_error = max(flow_error, table_error(
+                    (flow_table[0][select], flow_table[1][select]),
+                    np.exp(flow_values[:-1] + flow_step / 2),
+                    m_coeffs[select]))
+            gscript.verbose(
+                "Maximum relative error of the LS factor tables "
+                "{slope:.1e} for slopes above 1 degree "
+                "and {flow:.1e} for flow depth".format(
+                    slope=slope_error,
+                    flow=flow_error))
+
+    # fit blocks of rows into memory
+    block_rows = max(1, min(rows, budget // (cols * 8 * arrays)))
+    if stack and block_rows > stack.tile:
+        # align blocks with the chunks of the array store
+        block_rows -= block_rows % stack.tile
+    indices = []
+    if stack:
+        indices = [stack.scenario("{scenario}_member_{member}".format(
+            scenario=scenario, member=member))
+            for member in range(members)]
+    gscript.verbose(
+        "Evaluating {members} members in batches of {batch} "
+        "over blocks of {block_rows} rows".format(
+            members=members, batch=batch, block_rows=block_rows))
+
+    inputs = [open_raster(name)
+              for name in [slope, flowacc] + factors]
+    writers = {output: create_raster(output) for output in outputs}
+    try:
+        for start in range(0, rows, block_rows):
+            stop = min(start + block_rows, rows)
+            gscript.percent(start, rows, 1)
+            slope_block, flowacc_block, r_block, k_block, c_block = [
+                read_rows(raster, start, stop, cols) for raster in inputs]
+            if fast:
+                slope_position = grid_position(
+                    slope_block, slope_grid, slope_table)
+                flow_position = grid_position(
+                    np.log(flowacc_block * region.nsres / 22.1),
+                    flow_grid,
+                    flow_table)
+            else:
+                slope_term = np.sin(np.radians(slope_block)) / 5.14
+                flow_term = flowacc_block * region.nsres / 22.1
+
+            count = 0
+            mean = np.zeros(slope_block.shape)
+            m2 = np.zeros(slope_block.shape)
+            samples = None
+            if percentiles:
+                samples = np.empty((members,) + slope_block.shape)
+            for first in range(0, members, batch):
+                last = min(first + batch, members)
+                size = last - first
+                select = slice(first, last)
+                m = m_coeffs[select, None, None]
+                n = n_coeffs[select, None, None]
+
+                # E = R * K * LS * C converted from tons/ha/yr to kg/m^2s
+                if fast:
+                    ls_values = ((m + 1.0)
+                                 * lookup(flow_table, select, flow_position)
+                                 * lookup(slope_table, select, slope_position))
+                else:
+                    ls_values = ((m + 1.0)
+                                 * np.power(flow_term, m)
+                                 * np.power(slope_term, n))
+                values = np.maximum(r_block + shifts[0][select, None, None],
+                                    0.0)
+                values *= ls_values
+                values *= np.maximum(k_block + shifts[1][select, None, None],
+                                     0.0)
+                values *= np.maximum(c_block + shifts[2][select, None, None],
+                                     0.0)
+                values *= 1000. / 10000. / 31557600.
+                if samples is not None:
+                    samples[select] = values
+                for member, index in enumerate(indices[select]):
+                    stack.write('ls_factor', index, start, ls_values[member])
+                    stack.write('erosion', index, start, values[member])
+
+                # merge batch statistics with Welford's algorithm
+                batch_mean = values.mean(axis=0)
+                batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+                total = count + size
+                delta = batch_mean - mean
+                mean += delta * size / total
+                m2 += batch_m2 + delta ** 2 * count * size / total
+                count = total
+
+            if erosion_mean:
+                write_rows(writers[erosion_mean], mean)
+            if erosion_stddev:
+                if count > 1:
+                    write_rows(writers[erosion_stddev],
+                               np.sqrt(m2 / (count - 1)))
+                else:
+                    write_rows(writers[erosion_stddev], np.zeros(m2.shape))
+            if percentiles:
+                for name, values in zip(
+                        percentile_maps,
+                        np.percentile(samples, percentiles, axis=0)):
+                    write_rows(writers[name], values)
+        gscript.percent(rows, rows, 1)
+    finally:
+        for raster in inputs + list(writers.values()):
+            raster.close()
 
+    # set color tables
+    for output in outputs:
+        gscript.write_command(
+            'r.colors',
+            map=output,
+            rules='-',
+            stdin=sedflux_colors)
+    checkpoint.finish('rusle_ensemble' + suffix)
+    return outputs
+
+
+def power_table(bases, exponents):
+    """Tabulate powers of bases on a grid for each exponent
+    as values and differences between consecutive grid points"""
+    import numpy as np
+    values = np.power(bases[None, :], exponents[:, None])
+    return values, np.diff(values, axis=1)
+
+
+def grid_position(values, grid, table):
+    """Return the grid indices and linear interpolation weights of values
+    on the regular grid of a table, with NaN weights for null cells"""
+    import numpy as np
+    start, step = grid
+    size = table[0].shape[1]
+    position = (values - start) / step
+    valid = ~np.isnan(position)
+    position = np.clip(np.where(valid, position, 0.0), 0.0, size - 1.0)
+    index = np.minimum(position.astype(np.intp), size - 2)
+    weight = np.where(valid, position - index, np.nan)
+    return index, weight
+
+
+def lookup(table, select, position):
+    """Interpolate the tables of a batch of members at grid positions"""
+    values, differences = table
+    index, weight = position
+    return (values[select][:, index]
+            + weight * differences[select][:, index])
+
+
+def table_error(table, midpoints, exponents, select=slice(None)):
+    """Return the maximum relative error of interpolated tables
+    given the bases at the midpoints of their grid"""
+    import numpy as np
+    values, differences = table
+    exact = np.power(midpoints[None, :], exponents[:, None])
+    interpolated = values[:, :-1] + 0.5 * differences
+    error = np.abs(interpolated - exact)[:, select] / exact[:, select]
+    return float(np.nanmax(error)) if error.size else 0.0
+
+
+def query(elevation, coordinates, aoi, table, factors, m_coeff, n_coeff,
+          memory=300):
+    """Query RUSLE3D erosion at points or in small areas of interest
+
+    Slope and flow accumulation are computed once and kept as checkpoints,
+    so later queries only sample them at the points
+    or evaluate erosion in the window of the areas of interest
+    without writing maps of the region.
+    Factors are given as pairs of map name and constant value."""
+
+    # assign variables with names apart from user maps and intermediates
+    slope = 'r_erosion_query_slope'
+    grow_slope = 'r_erosion_query_grow_slope'
+    flowacc = 'r_erosion_query_flowacc'
+    zones = 'r_erosion_query_zones_{pid}'.format(pid=os.getpid())
+    erosion = 'r_erosion_query_erosion_{pid}'.format(pid=os.getpid())
+    suffix = '_r_erosion_query'
+
+    # compute or reuse slope and flow accumulation
+    compute_slope(elevation, slope, grow_slope, suffix)
+    depth = compute_flow_accumulation(
+        elevation, flowacc, '', suffix, memory=memory)
+    region = gscript.region()
+    res = region['nsres']
+    m_coeff = float(m_coeff)
+    n_coeff = float(n_coeff)
 
-def usped(elevation, erosion, flow_accumulation, r_factor, c_factor, k_factor, ls_factor, m_coeff, n_coeff):
+    if table and table != '-':
+        output = open(table, 'w')
+    else:
+        output = sys.stdout
+    try:
+        # sample slope, flow accumulation and factors at points
+        if coordinates:
+            output.write(
+                "east,north,slope,flow_accumulation,ls_factor,erosion\n")
+            maps = [slope, flowacc] + [name for name, value in factors
+                                       if name]
+            samples = gscript.read_command(
+                'r.what',
+                map=maps,
+                coordinates=coordinates,
+                separator='comma',
+                null_value='nan')
+            for line in samples.splitlines():
+                fields = line.split(',')
+                values = [float(value) for value in fields[3:]]
+                slope_value = values.pop(0)
+                depth_value = values.pop(0) * res
+                r_value, k_value, c_value = [
+                    values.pop(0) if name else float(value)
+                    for name, value in factors]
+
+                # LS = (m + 1) * (A / 22.1)^m * (sin(slope) / 5.14)^n
+                ls_value = ((m_coeff + 1.0)
+                            * (depth_value / 22.1) ** m_coeff
+                            * (math.sin(math.radians(slope_value)) / 5.14)
+                            ** n_coeff)
+
+                # E = R * K * LS * C converted from tons/ha/yr to kg/m^2s
+                erosion_value = (r_value * k_value * ls_value * c_value
+                                 * 1000. / 10000. / 31557600.)
+                output.write(
+                    "{east},{north},{slope},{depth},{ls},{erosion}\n".format(
+                        east=fields[0],
+                        north=fields[1],
+                        slope=slope_value,
+                        depth=depth_value,
+                        ls=ls_value,
+                        erosion=erosion_value))
+
+        # evaluate erosion in the window of the areas of interest
+        if aoi:
+            window = os.environ.copy()
+            window['GRASS_REGION'] = gscript.region_env(
+                vector=aoi,
+                align=flowacc)
+            try:
+                gscript.run_command(
+                    'v.to.rast',
+                    input=aoi,
+                    output=zones,
+                    use='cat',
+                    overwrite=True,
+                    quiet=True,
+                    env=window)
+                gscript.run_command(
+                    'r.mapcalc',
+                    expression="{erosion}"
+                    "={r_factor}"
+                    "*{k_factor}"
+                    "*({m}+1.0)"
+                    "*(({flowacc}/22.1)^{m})"
+                    "*((sin({slope})/5.14)^{n})"
+                    "*{c_factor}"
+                    "*{ton_to_kg}"
+                    "/{ha_to_m2}"
+                    "/{yr_to_s}".format(
+                        erosion=erosion,
+                        r_factor=factors[0][0] or factors[0][1],
+                        k_factor=factors[1][0] or factors[1][1],
+                        c_factor=factors[2][0] or factors[2][1],
+                        m=m_coeff,
+                        n=n_coeff,
+                        flowacc=depth,
+                        slope=slope,
+                        ton_to_kg=1000.,
+                        ha_to_m2=10000.,
+                        yr_to_s=31557600.),
+                    overwrite=True,
+                    quiet=True,
+                    env=window)
+                statistics = gscript.read_command(
+                    'r.univar',
+                    map=erosion,
+                    zones=zones,
+                    separator='comma',
+                    flags='t',
+                    env=window).splitlines()
+            finally:
+                gscript.run_command(
+                    'g.remove',
+                    type='raster',
+                    name=[zones, erosion],
+                    flags='f',
+                    quiet=True)
+            output.write("cat,cells,erosion_mean,erosion_min,"
+                         "erosion_max,erosion_sum\n")
+            columns = statistics[0].split(',')
+            for line in statistics[1:]:
+                zone = dict(zip(columns, line.split(',')))
+                output.write(
+                    "{cat},{cells},{mean},{min},{max},{sum}\n".format(
+                        cat=zone['zone'],
+                        cells=zone['non_null_cells'],
+                        mean=zone['mean'],
+                        min=zone['min'],
+                        max=zone['max'],
+                        sum=zone['sum']))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def open_raster(name):
+    """Open a raster map for reading rows in the current region"""
+    from grass.pygrass.raster import RasterRow
+    raster = RasterRow(name)
+    raster.open('r')
+    return raster
+
+
+def create_raster(name):
+    """Open a new double precision raster map for writing rows"""
+    from grass.pygrass.raster import RasterRow
+    raster = RasterRow(name)
+    raster.open('w', 'DCELL', overwrite=True)
+    return raster
+
+
+def read_rows(raster, start, stop, cols):
+    """Read a block of rows as floating point values with NaN for nulls"""
+    import numpy as np
+    block = np.empty((stop - start, cols))
+    for row in range(start, stop):
+        values = raster.get_row(row)
+        block[row - start] = values
+        if raster.mtype == 'CELL':
+            block[row - start][values == CELL_NULL] = np.nan
+    return block
+
+
+def write_rows(raster, block):
+    """Append a block of rows with NaN for nulls"""
+    from grass.pygrass.raster.buffer import Buffer
+    for values in block:
+        row = Buffer((block.shape[1],), mtype='DCELL')
+        row[:] = values
+        raster.put_row(row)
+
+
+def usped(elevation, erosion, flow_accumulation, r_factor, c_factor, k_factor, ls_factor, m_coeff, n_coeff, suffix='', memory=300):
     """The USPED (Unit Stream Power Erosion Deposition) model
-    for transport limited erosion regimes"""
+    for transport limited erosion regimes
+
+    Flow accumulation and LS factor maps are only written if requested,
+    otherwise their expressions are evaluated within the sediment flow
+    expressions"""
 
     # assign variables
-    slope = 'slope'
-    aspect = 'aspect'
-    flowacc = 'flowacc'
-    qsx = 'qsx'
-    qsxdx = 'qsxdx'
-    qsy = 'qsy'
-    qsydy = 'qsydy'
-    grow_slope = 'grow_slope'
-    grow_aspect = 'grow_aspect'
-    grow_qsxdx = 'grow_qsxdx'
-    grow_qsydy = 'grow_qsydy'
-    sedflow = 'sedflow'
-    sediment_flux = 'sediment_flux'
+    slope = 'slope' + suffix
+    aspect = 'aspect' + suffix
+    flowacc = 'flowacc' + suffix
+    qsx = 'qsx' + suffix
+    qsxdx = 'qsxdx' + suffix
+    qsy = 'qsy' + suffix
+    qsydy = 'qsydy' + suffix
+    grow_slope = 'grow_slope' + suffix
+    grow_aspect = 'grow_aspect' + suffix
+    grow_qsxdx = 'grow_qsxdx' + suffix
+    grow_qsydy = 'grow_qsydy' + suffix
+    temporary_maps.extend(
+        [slope, aspect, flowacc, qsx, qsy, qsxdx, qsydy,
+         grow_slope, grow_aspect, grow_qsxdx, grow_qsydy])
 
     # compute slope and aspect
-    gscript.run_command(
-        'r.slope.aspect',
-        elevation=elevation,
-        slope=slope,
-        aspect=aspect,
-        overwrite=True)
-
-    # grow border to fix edge effects of moving window computations
-    gscript.run_command(
-        'r.grow.distance',
-        input=slope,
-        value=grow_slope,
-        overwrite=True)
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{slope}={grow_slope}".format(
+    if checkpoint.start('slope_aspect' + suffix, inputs=[elevation],
+                        outputs=[slope, aspect, grow_slope, grow_aspect]):
+        gscript.run_command(
+            'r.slope.aspect',
+            elevation=elevation,
             slope=slope,
-            grow_slope=grow_slope),
-        overwrite=True)
-    gscript.run_command(
-        'r.grow.distance',
-        input=aspect,
-        value=grow_aspect,
-        overwrite=True)
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{aspect}={grow_aspect}".format(
             aspect=aspect,
-            grow_aspect=grow_aspect),
-        overwrite=True)
+            overwrite=True)
+
+        # grow border to fix edge effects of moving window computations
+        gscript.run_command(
+            'r.grow.distance',
+            input=slope,
+            value=grow_slope,
+            overwrite=True)
+        gscript.run_command(
+            'r.mapcalc',
+            expression="{slope}={grow_slope}".format(
+                slope=slope,
+                grow_slope=grow_slope),
+            overwrite=True)
+        gscript.run_command(
+            'r.grow.distance',
+            input=aspect,
+            value=grow_aspect,
+            overwrite=True)
+        gscript.run_command(
+            'r.mapcalc',
+            expression="{aspect}={grow_aspect}".format(
+                aspect=aspect,
+                grow_aspect=grow_aspect),
+            overwrite=True)
+        checkpoint.finish('slope_aspect' + suffix)
 
     # compute flow accumulation
-    gscript.run_command(
-        'r.watershed',
-        elevation=elevation,
-        accumulation=flowacc,
-        flags="a",
-        overwrite=True)
-    region = gscript.parse_command(
-        'g.region', flags='g')
-    res = region['nsres']
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{depth}"
-        "=({flowacc}*{res})".format(
-            depth=flow_accumulation,
-            flowacc=flowacc,
-            res=res),
-        overwrite=True)
-    gscript.run_command(
-        'r.colors',
-        map=flow_accumulation,
-        raster=flowacc)
+    depth = compute_flow_accumulation(elevation, flowacc, flow_accumulation,
+                                      suffix, memory)
     # add depression parameter to r.watershed
     # derive from landcover class
 
     # compute dimensionless topographic factor
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{ls_factor}"
-        "=({flowacc}^{m})*(sin({slope})^{n})".format(
+    ls = "({flowacc}^{m})*(sin({slope})^{n})".format(
+        m=m_coeff,
+        flowacc=depth,
+        slope=slope,
+        n=n_coeff)
+    if ls_factor:
+        expression = "{ls_factor}={ls}".format(
             ls_factor=ls_factor,
-            m=m_coeff,
-            flowacc=flow_accumulation,
-            slope=slope,
-            n=n_coeff),
-        overwrite=True)
+            ls=ls)
+        if checkpoint.start('usped_ls_factor' + suffix,
+                            inputs=[flowacc, slope, flow_accumulation],
+                            outputs=[ls_factor],
+                            params=[expression]):
+            gscript.run_command(
+                'r.mapcalc',
+                expression=expression,
+                overwrite=True)
+            gscript.write_command(
+                'r.colors',
+                map=ls_factor,
+                rules='-',
+                stdin=lsfactor_colors)
+            checkpoint.finish('usped_ls_factor' + suffix)
+        ls = ls_factor
 
     # compute sediment flow at sediment transport capacity
     """
@@ -589,19 +2484,6 @@ def usped(elevation, erosion, flow_accumulation, r_factor, c_factor, k_factor, l
     LST is the topographic component of sediment transport capacity
     of overland flow
     """
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{sedflow}"
-        "={r_factor}"
-        "*{k_factor}"
-        "*{c_factor}"
-        "*{ls_factor}".format(
-            r_factor=r_factor,
-            k_factor=k_factor,
-            c_factor=c_factor,
-            ls_factor=ls_factor,
-            sedflow=sedflow),
-        overwrite=True)
 
     # # convert sediment flow from tons/ha/s to kg/m^2/s
     # gscript.run_command(
@@ -617,141 +2499,125 @@ def usped(elevation, erosion, flow_accumulation, r_factor, c_factor, k_factor, l
     #     overwrite=True)
 
     # convert sediment flow from tons/ha/yr to kg/m^2s
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{converted_sedflow}"
-        "={sedflow}"
+    sediment_flux = (
+        "({r_factor}"
+        "*{k_factor}"
+        "*{c_factor}"
+        "*({ls_factor})"
         "*{ton_to_kg}"
         "/{ha_to_m2}"
-        "/{yr_to_s}".format(
-            converted_sedflow=sediment_flux,
-            sedflow=sedflow,
+        "/{yr_to_s})".format(
+            r_factor=r_factor,
+            k_factor=k_factor,
+            c_factor=c_factor,
+            ls_factor=ls,
             ton_to_kg=1000.,
             ha_to_m2=10000.,
-            yr_to_s=31557600.),
-        overwrite=True)
-
-    # compute sediment flow rate in x direction (m^2/s)
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{qsx}={sedflow}*cos({aspect})".format(
-            sedflow=sediment_flux,
-            aspect=aspect, qsx=qsx),
-        overwrite=True)
+            yr_to_s=31557600.))
 
-    # compute sediment flow rate in y direction (m^2/s)
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{qsy}={sedflow}*sin({aspect})".format(
+    # compute sediment flow rate in x and y direction (m^2/s)
+    expression = (
+        "{qsx}={sedflow}*cos({aspect})\n"
+        "{qsy}={sedflow}*sin({aspect})".format(
             sedflow=sediment_flux,
             aspect=aspect,
-            qsy=qsy),
-        overwrite=True)
+            qsx=qsx,
+            qsy=qsy))
+    if checkpoint.start('sediment_flow' + suffix,
+                        inputs=[r_factor, k_factor, c_factor, flowacc, slope,
+                                aspect, flow_accumulation, ls_factor],
+                        outputs=[qsx, qsy],
+                        params=[expression]):
+        gscript.run_command(
+            'r.mapcalc',
+            expression=expression,
+            overwrite=True)
+        checkpoint.finish('sediment_flow' + suffix)
 
-    # compute change in sediment flow in x direction
-    # as partial derivative of sediment flow field
-    gscript.run_command(
-        'r.slope.aspect',
-        elevation=qsx,
-        dx=qsxdx,
-        overwrite=True)
+    if checkpoint.start('divergence' + suffix,
+                        inputs=[qsx, qsy],
+                        outputs=[qsxdx, qsydy, grow_qsxdx, grow_qsydy]):
+        # compute change in sediment flow in x direction
+        # as partial derivative of sediment flow field
+        gscript.run_command(
+            'r.slope.aspect',
+            elevation=qsx,
+            dx=qsxdx,
+            overwrite=True)
 
-    # compute change in sediment flow in y direction
-    # as partial derivative of sediment flow field
-    gscript.run_command(
-        'r.slope.aspect',
-        elevation=qsy,
-        dy=qsydy,
-        overwrite=True)
+        # compute change in sediment flow in y direction
+        # as partial derivative of sediment flow field
+        gscript.run_command(
+            'r.slope.aspect',
+            elevation=qsy,
+            dy=qsydy,
+            overwrite=True)
 
-    # grow border to fix edge effects of moving window computations
-    gscript.run_command(
-        'r.grow.distance',
-        input=qsxdx,
-        value=grow_qsxdx,
-        overwrite=True)
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{qsxdx}={grow_qsxdx}".format(
-            qsxdx=qsxdx,
-            grow_qsxdx=grow_qsxdx),
-        overwrite=True)
-    gscript.run_command(
-        'r.grow.distance',
-        input=qsydy,
-        value=grow_qsydy,
-        overwrite=True)
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{qsydy}={grow_qsydy}".format(
-            qsydy=qsydy,
-            grow_qsydy=grow_qsydy),
-        overwrite=True)
+        # grow border to fix edge effects of moving window computations
+        gscript.run_command(
+            'r.grow.distance',
+            input=qsxdx,
+            value=grow_qsxdx,
+            overwrite=True)
+        gscript.run_command(
+            'r.mapcalc',
+            expression="{qsxdx}={grow_qsxdx}".format(
+                qsxdx=qsxdx,
+                grow_qsxdx=grow_qsxdx),
+            overwrite=True)
+        gscript.run_command(
+            'r.grow.distance',
+            input=qsydy,
+            value=grow_qsydy,
+            overwrite=True)
+        gscript.run_command(
+            'r.mapcalc',
+            expression="{qsydy}={grow_qsydy}".format(
+                qsydy=qsydy,
+                grow_qsydy=grow_qsydy),
+            overwrite=True)
+        checkpoint.finish('divergence' + suffix)
 
     # compute net erosion-deposition (kg/m^2s)
     # as divergence of sediment flow
-    gscript.run_command(
-        'r.mapcalc',
-        expression="{erdep} = {qsxdx} + {qsydy}".format(
-            erdep=erosion,
-            qsxdx=qsxdx,
-            qsydy=qsydy),
-        overwrite=True)
-
-    # set color tables
-    gscript.write_command(
-        'r.colors',
-        map=ls_factor,
-        rules='-',
-        stdin=lsfactor_colors)
-    gscript.write_command(
-        'r.colors',
-        map=erosion,
-        rules='-',
-        stdin=erosion_colors)
+    if checkpoint.start('erosion_deposition' + suffix,
+                        inputs=[qsxdx, qsydy],
+                        outputs=[erosion]):
+        gscript.run_command(
+            'r.mapcalc',
+            expression="{erdep} = {qsxdx} + {qsydy}".format(
+                erdep=erosion,
+                qsxdx=qsxdx,
+                qsydy=qsydy),
+            overwrite=True)
 
-    # remove temporary maps
-    gscript.run_command(
-        'g.remove',
-        type='raster',
-        name=['slope',
-              'aspect',
-              'flowacc',
-              'qsx',
-              'qsy',
-              'qsxdx',
-              'qsydy',
-              'grow_slope',
-              'grow_aspect',
-              'grow_qsxdx',
-              'grow_qsydy',
-              'sedflow',
-              'sediment_flux'],
-        flags='f')
+        # set color tables
+        gscript.write_command(
+            'r.colors',
+            map=erosion,
+            rules='-',
+            stdin=erosion_colors)
+        checkpoint.finish('erosion_deposition' + suffix)
 
 
 def cleanup():
+    # keep intermediate maps for resuming from checkpoints
+    if checkpoint.enabled:
+        return
+
+    # remove the scratch mapset with all its intermediate maps
+    # instead of maps of the same name in the target mapset
+    if scratch.mapset:
+        scratch.remove()
+        return
     try:
         # remove temporary maps
-        gscript.run_command(
-            'g.remove',
-            type='raster',
-            name=['rain_volume',
-                  'rain_energy',
-                  'slope',
-                  'aspect',
-                  'flowacc',
-                  'qsx',
-                  'qsy',
-                  'qsxdx',
-                  'qsydy',
-                  'grow_slope',
-                  'grow_aspect',
-                  'grow_qsxdx',
-                  'grow_qsydy',
-                  'sedflow',
-                  'sediment_flux'],
-            flags='f')
+        if temporary_maps:
+            gscript.run_command(
+                'g.remove',
+                type='raster',
+                name=temporary_maps,
+                flags='f')
 
     except CalledModuleError:
         pass
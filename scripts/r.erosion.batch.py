@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+MODULE:    r.erosion.batch
+
+AUTHOR(S): Brendan Harmon <brendan.harmon@gmail.com>
+
+PURPOSE:   Erosion modeling for many areas of interest in GRASS GIS
+
+COPYRIGHT: (C) 2019 Brendan Harmon and the GRASS Development Team
+
+           This program is free software under the GNU General Public
+           License (>=v2). Read the file COPYING that comes with GRASS
+           for details.
+"""
+
+#%module
+#% description: Erosion modeling for each area of interest of a vector map
+#% keyword: raster
+#% keyword: terrain
+#% keyword: erosion
+#%end
+
+#%option G_OPT_R_ELEV
+#% key: elevation
+#% description: Name of elevation raster map
+#% required: yes
+#% guisection: Basic
+#%end
+
+#%option G_OPT_V_INPUT
+#% key: aoi
+#% description: Vector map of areas of interest
+#% label: Areas of interest
+#% required: yes
+#% guisection: Basic
+#%end
+
+#%option
+#% key: model
+#% type: string
+#% options: rusle,usped
+#% description: RUSLE3D or USPED erosion model
+#% descriptions:rusle;RUSLE 3D detachment limited model;usped;USPED transport limited model
+#% label: Erosion model
+#% required: yes
+#% answer: rusle
+#% guisection: Basic
+#%end
+
+#%option
+#% key: r_factor_value
+#% type: double
+#% description: Erosivity factor constant
+#% label: R factor constant
+#% answer: 310.0
+#% multiple: no
+#% guisection: Input
+#%end
+
+#%option G_OPT_R_INPUT
+#% key: r_factor
+#% description: Erosivity factor map
+#% label: R factor
+#% required: no
+#% guisection: Input
+#%end
+
+#%option
+#% key: rain_intensity
+#% type: integer
+#% description: Rainfall intensity in mm/hr
+#% multiple: no
+#% required: no
+#% guisection: Input
+#%end
+
+#%option
+#% key: rain_duration
+#% type: integer
+#% description: Total duration of storm event or duration of each time step of a rainfall time series in minutes
+#% multiple: no
+#% required: no
+#% guisection: Input
+#%end
+
+#%option G_OPT_STRDS_INPUT
+#% key: rainfall
+#% description: Space time raster dataset of rainfall intensity in mm/hr
+#% label: Rainfall time series
+#% required: no
+#% guisection: Input
+#%end
+
+#%option
+#% key: k_factor_value
+#% type: double
+#% description: Soil erodibility constant
+#% label: K factor constant
+#% answer: 0.25
+#% multiple: no
+#% guisection: Input
+#%end
+
+#%option G_OPT_R_INPUT
+#% key: k_factor
+#% description: Soil erodibility factor
+#% label: K factor
+#% required: no
+#% guisection: Input
+#%end
+
+#%option
+#% key: c_factor_value
+#% type: double
+#% description: Land cover constant
+#% label: C factor constant
+#% answer: 0.1
+#% multiple: no
+#% guisection: Input
+#%end
+
+#%option G_OPT_R_INPUT
+#% key: c_factor
+#% description: Land cover factor
+#% label: C factor
+#% required: no
+#% guisection: Input
+#%end
+
+#%option
+#% key: m_coeff
+#% type: double
+#% description: Water flow exponent
+#% label: Water flow exponent
+#% answer: 1.5
+#% multiple: no
+#% guisection: Input
+#%end
+
+#%option
+#% key: n_coeff
+#% type: double
+#% description: Slope exponent
+#% label: Slope exponent
+#% answer: 1.2
+#% multiple: no
+#% guisection: Input
+#%end
+
+#%option
+#% key: erosion
+#% type: string
+#% description: Basename for erosion maps of each area of interest
+#% label: Erosion basename
+#% required: yes
+#% answer: erosion
+#% guisection: Output
+#%end
+
+#%option
+#% key: flow_accumulation
+#% type: string
+#% description: Basename for flow accumulation maps of each area of interest
+#% label: Flow accumulation basename
+#% required: no
+#% guisection: Output
+#%end
+
+#%option
+#% key: ls_factor
+#% type: string
+#% description: Basename for LS factor maps of each area of interest
+#% label: LS factor basename
+#% required: no
+#% guisection: Output
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: table
+#% description: Table of erosion statistics of each area of interest (default: standard output)
+#% label: Output table
+#% required: no
+#% guisection: Output
+#%end
+
+#%option G_OPT_MEMORYMB
+#% description: Memory budget shared by concurrent jobs (MB)
+#% guisection: Settings
+#%end
+
+#%option G_OPT_M_NPROCS
+#% description: Number of concurrent jobs, or 0 for all cores and a negative number for all but as many cores
+#% guisection: Settings
+#%end
+
+#%option
+#% key: scratch
+#% type: string
+#% gisprompt: old,dir,dir
+#% description: Fast directory such as /dev/shm for the mapsets of jobs
+#% label: Scratch directory
+#% required: no
+#% guisection: Settings
+#%end
+
+import os
+import sys
+import time
+import types
+import shutil
+import atexit
+import threading
+import multiprocessing
+from importlib.machinery import SourceFileLoader
+import grass.script as gscript
+from grass.exceptions import CalledModuleError
+
+# mapsets of jobs removed on exit
+job_mapsets = []
+
+# options passed on to r.erosion
+model_options = ['r_factor_value', 'r_factor', 'rain_intensity',
+                 'rain_duration', 'rainfall', 'k_factor_value', 'k_factor',
+                 'c_factor_value', 'c_factor', 'm_coeff', 'n_coeff']
+
+
+def main():
+    options, flags = gscript.parser()
+    aoi = options['aoi']
+    memory = int(options['memory'])
+    nprocs = int(options['nprocs'])
+    if nprocs <= 0:
+        # all cores, leaving as many cores as a negative number
+        nprocs = max(1, multiprocessing.cpu_count() + nprocs)
+    atexit.register(cleanup)
+    erosion = load_erosion()
+
+    # find the rainfall time series in the search path of the current mapset
+    if options['rainfall']:
+        options['rainfall'] = gscript.parse_command(
+            't.info',
+            input=options['rainfall'],
+            flags='g')['id']
+    parameters = {name: options[name] for name in model_options
+                  if options[name]}
+
+    # list the categories of the areas of interest
+    categories = sorted(set(
+        int(line.split('/')[0]) for line in gscript.read_command(
+            'v.category',
+            input=aoi,
+            option='print',
+            type='area').split()))
+    if not categories:
+        gscript.fatal("No areas of interest in {aoi}".format(aoi=aoi))
+
+    # prepare a mapset with the region and mask of each job
+    # and estimate its runtime and memory
+    jobs = []
+    for cat in categories:
+        job = prepare_job(erosion, cat, options)
+        estimate = gscript.parse_command(
+            'r.erosion',
+            flags='e',
+            elevation=options['elevation'],
+            model=options['model'],
+            memory=memory,
+            env=job['env'],
+            **parameters)
+        job['cells'] = int(estimate['masked_cells'])
+        job['seconds'] = float(estimate['runtime_seconds'])
+        job['memory'] = min(
+            int(float(estimate['peak_memory_mb'])) + 1, memory)
+        jobs.append(job)
+    gscript.message(
+        "Running {count} jobs with an estimated {seconds:.0f} s".format(
+            count=len(jobs),
+            seconds=sum(job['seconds'] for job in jobs)))
+
+    # run jobs on the available cores within the memory budget
+    schedule(jobs, nprocs, memory, options, parameters)
+
+    # write the table of erosion statistics
+    if options['table'] and options['table'] != '-':
+        output = open(options['table'], 'w')
+    else:
+        output = sys.stdout
+    try:
+        output.write("cat,cells,seconds,memory_mb,erosion_mean,"
+                     "erosion_min,erosion_max,erosion_sum\n")
+        for job in sorted(jobs, key=lambda job: job['cat']):
+            if 'statistics' not in job:
+                continue
+            statistics = job['statistics']
+            output.write(
+                "{cat},{cells},{seconds:.1f},{memory},"
+                "{mean},{min},{max},{sum}\n".format(
+                    cat=job['cat'],
+                    cells=statistics['n'],
+                    seconds=job['elapsed'],
+                    memory=job['memory'],
+                    mean=statistics['mean'],
+                    min=statistics['min'],
+                    max=statistics['max'],
+                    sum=statistics['sum']))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    failed = [job['cat'] for job in jobs if 'statistics' not in job]
+    if failed:
+        gscript.fatal("Jobs failed for areas of interest {cats}".format(
+            cats=','.join(str(cat) for cat in failed)))
+    sys.exit(0)
+
+
+def load_erosion():
+    """Load r.erosion from this repository or the add-on path
+    to share its helpers"""
+    path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        os.pardir,
+        'r.erosion.py')
+    if not os.path.exists(path):
+        path = shutil.which('r.erosion')
+    if not path:
+        gscript.fatal("Cannot find the r.erosion module")
+    loader = SourceFileLoader('r_erosion', path)
+    module = types.ModuleType(loader.name)
+    loader.exec_module(module)
+    return module
+
+
+def prepare_job(erosion, cat, options):
+    """Create a mapset with the region and mask of an area of interest"""
+    env = gscript.gisenv()
+    location = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+    target = env['MAPSET']
+    mapset = 'r_erosion_batch_{cat}_{pid}'.format(cat=cat, pid=os.getpid())
+    job_mapsets.append(os.path.join(location, mapset))
+
+    # create the mapset, on a fast path if given,
+    # and set the environment of the job
+    job_env = os.environ.copy()
+    job_env['GISRC'] = erosion.create_mapset(
+        mapset, options['scratch'] or None)
+    for variable in ['GRASS_REGION', 'WIND_OVERRIDE']:
+        job_env.pop(variable, None)
+
+    # set the region and mask to the area of interest
+    area = 'aoi_{cat}'.format(cat=cat)
+    gscript.run_command(
+        'v.extract',
+        input=options['aoi'],
+        output=area,
+        cats=cat,
+        quiet=True,
+        env=job_env)
+    gscript.run_command(
+        'g.region',
+        vector=area,
+        align=options['elevation'],
+        env=job_env)
+    gscript.run_command(
+        'r.mask',
+        vector=area,
+        quiet=True,
+        env=job_env)
+    return {'cat': cat, 'mapset': mapset, 'target': target, 'env': job_env}
+
+
+def schedule(jobs, nprocs, memory, options, parameters):
+    """Run the longest jobs first on up to nprocs cores,
+    starting a job only when its estimated memory fits in the budget"""
+    pending = sorted(jobs, key=lambda job: job['seconds'], reverse=True)
+    condition = threading.Condition()
+    running = {'jobs': 0, 'memory': 0}
+    threads = []
+
+    def run(job):
+        try:
+            run_job(job, options, parameters)
+        except CalledModuleError:
+            gscript.warning("Job for area of interest {cat} failed".format(
+                cat=job['cat']))
+        finally:
+            with condition:
+                running['jobs'] -= 1
+                running['memory'] -= job['memory']
+                condition.notify_all()
+
+    while pending:
+        with condition:
+            # wait for a core and memory for the longest job that fits,
+            # running jobs larger than the budget on their own
+            while True:
+                job = None
+                if running['jobs'] < nprocs:
+                    job = next(
+                        (job for job in pending
+                         if running['memory'] + job['memory'] <= memory
+                         or not running['jobs']), None)
+                if job:
+                    break
+                condition.wait()
+            pending.remove(job)
+            running['jobs'] += 1
+            running['memory'] += job['memory']
+        thread = threading.Thread(target=run, args=(job,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def run_job(job, options, parameters):
+    """Run r.erosion for an area of interest
+    and copy its outputs into the target mapset"""
+    cat = job['cat']
+    outputs = {}
+    for name in ['erosion', 'flow_accumulation', 'ls_factor']:
+        if options[name]:
+            outputs[name] = '{basename}_{cat}'.format(
+                basename=options[name],
+                cat=cat)
+    parameters = dict(parameters, **outputs)
+
+    # run the model in the mapset of the job
+    start = time.time()
+    gscript.run_command(
+        'r.erosion',
+        elevation=options['elevation'],
+        model=options['model'],
+        memory=job['memory'],
+        overwrite=True,
+        quiet=True,
+        env=job['env'],
+        **parameters)
+    job['elapsed'] = time.time() - start
+    statistics = gscript.parse_command(
+        'r.univar',
+        map=outputs['erosion'],
+        flags='g',
+        env=job['env'])
+
+    # copy outputs into the target mapset
+    for output in outputs.values():
+        gscript.run_command(
+            'g.copy',
+            raster=['{name}@{mapset}'.format(
+                name=output,
+                mapset=job['mapset']), output],
+            overwrite=True,
+            quiet=True)
+    job['statistics'] = statistics
+
+
+def cleanup():
+    # remove mapsets of jobs
+    for path in job_mapsets:
+        if os.path.islink(path):
+            shutil.rmtree(os.path.realpath(path), ignore_errors=True)
+            os.remove(path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
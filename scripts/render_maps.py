@@ -15,26 +15,21 @@ LICENSE:   This program is free software under the GNU General Public
 import os
 import sys
 import atexit
+import multiprocessing
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
 
 # set graphics driver
 driver = "cairo"
 
-# temporary region
-gscript.use_temp_region()
-
 # set environment
 env = gscript.gisenv()
-
-overwrite = True
-env['GRASS_OVERWRITE'] = overwrite
-env['GRASS_VERBOSE'] = False
-env['GRASS_MESSAGE_FORMAT'] = 'standard'
 gisdbase = env['GISDBASE']
 location = env['LOCATION_NAME']
 mapset = env['MAPSET']
-res=1
+res = 1
+align = 'elevation_2012'
+relief = 'relief_2012'
 
 # set 2D rendering parameters
 legend_coord = (2, 32, 2, 4)
@@ -45,66 +40,135 @@ font = 'Lato-Regular'
 fontsize = 26
 vector_width = 3
 
-# create rendering directory
-render = os.path.join(gisdbase, 'images', 'erosion')
-if not os.path.exists(render):
-    os.makedirs(render)
-
-# set region
-gscript.run_command('g.region', region='region', res=res, align='elevation_2012')
-
-# set mask
-gscript.run_command('r.mask', vector='watershed')
-
-# render sediment flow
-gscript.run_command('d.mon',
-    start=driver,
-    width=width,
-    height=height,
-    output=os.path.join(render, 'sediment_flow_2012.png'),
-    overwrite=overwrite)
-gscript.run_command('d.shade',
-    shade='relief_2012',
-    color='erosion',
-    brighten=0)
-gscript.run_command('d.legend',
-    raster='erosion',
-    font=font,
-    fontsize=fontsize,
-    at=legend_coord)
-gscript.run_command('d.mon', stop=driver)
-
-# remove mask
-gscript.run_command('r.mask', flags='r')
-
-# create rendering directory
-render = os.path.join(gisdbase, 'images', 'erosion_detail')
-if not os.path.exists(render):
-    os.makedirs(render)
-
-# set region
-gscript.run_command('g.region', region='subregion', res=res, align='elevation_2012')
-
-# set mask
-gscript.run_command('r.mask', vector='subwatershed')
-
-# render sediment flow
-gscript.run_command('d.mon',
-    start=driver,
-    width=width,
-    height=height,
-    output=os.path.join(render, 'sediment_flow_2012.png'),
-    overwrite=overwrite)
-gscript.run_command('d.shade',
-    shade='relief_2012',
-    color='erosion',
-    brighten=0)
-gscript.run_command('d.legend',
-    raster='erosion',
-    font=font,
-    fontsize=fontsize,
-    at=legend_coord)
-gscript.run_command('d.mon', stop=driver)
-
-# remove mask
-gscript.run_command('r.mask', flags='r')
+# set number of parallel rendering processes
+processes = multiprocessing.cpu_count()
+
+# set render jobs as (raster, image, region, mask, directory)
+jobs = [
+    ('erosion', 'sediment_flow_2012', 'region', 'watershed', 'erosion'),
+    ('erosion', 'sediment_flow_2012', 'subregion', 'subwatershed',
+     'erosion_detail')]
+
+# cached relief maps
+cache = []
+
+
+def main():
+    # cache the masked relief of each region and mask
+    reliefs = {}
+    for raster, image, region, mask, directory in jobs:
+        if (region, mask) not in reliefs:
+            reliefs[(region, mask)] = cache_relief(region, mask)
+
+    # render in parallel
+    pool = multiprocessing.Pool(processes)
+    try:
+        pool.map(
+            render,
+            [(raster, image, region, reliefs[(region, mask)], directory)
+             for raster, image, region, mask, directory in jobs])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def region_environment(region):
+    """Return an environment with a temporary region"""
+    region_env = os.environ.copy()
+    region_env['GRASS_REGION'] = gscript.region_env(
+        region=region,
+        res=res,
+        align=align)
+    return region_env
+
+
+def cache_relief(region, mask):
+    """Mask the relief once for each region and mask
+    instead of rendering it with a mask for each map"""
+    region_env = region_environment(region)
+    mask_raster = 'render_mask_{region}_{mask}'.format(
+        region=region, mask=mask)
+    masked_relief = 'render_relief_{region}_{mask}'.format(
+        region=region, mask=mask)
+    cache.extend([mask_raster, masked_relief])
+    gscript.run_command(
+        'v.to.rast',
+        input=mask,
+        output=mask_raster,
+        use='val',
+        overwrite=True,
+        env=region_env)
+    gscript.run_command(
+        'r.mapcalc',
+        expression="{masked_relief}"
+        "=if(isnull({mask_raster}),null(),{relief})".format(
+            masked_relief=masked_relief,
+            mask_raster=mask_raster,
+            relief=relief),
+        overwrite=True,
+        env=region_env)
+    gscript.run_command(
+        'r.colors',
+        map=masked_relief,
+        raster=relief,
+        env=region_env)
+    return masked_relief
+
+
+def render(job):
+    """Render a shaded map with its own region and image file"""
+    raster, image, region, masked_relief, directory = job
+
+    # create rendering directory
+    render_directory = os.path.join(gisdbase, 'images', directory)
+    try:
+        os.makedirs(render_directory)
+    except OSError:
+        if not os.path.isdir(render_directory):
+            raise
+
+    # set rendering environment
+    render_env = region_environment(region)
+    output = os.path.join(render_directory, image + '.png')
+    if os.path.exists(output):
+        os.remove(output)
+    render_env['GRASS_RENDER_IMMEDIATE'] = driver
+    render_env['GRASS_RENDER_FILE'] = output
+    render_env['GRASS_RENDER_FILE_READ'] = 'TRUE'
+    render_env['GRASS_RENDER_WIDTH'] = str(width)
+    render_env['GRASS_RENDER_HEIGHT'] = str(height)
+    render_env['GRASS_OVERWRITE'] = '1'
+    render_env['GRASS_VERBOSE'] = '0'
+
+    # render map
+    gscript.run_command('d.shade',
+        shade=masked_relief,
+        color=raster,
+        brighten=0,
+        env=render_env)
+    gscript.run_command('d.legend',
+        raster=raster,
+        font=font,
+        fontsize=fontsize,
+        at=legend_coord,
+        env=render_env)
+
+
+def cleanup():
+    try:
+        # remove cached relief maps
+        if cache:
+            gscript.run_command(
+                'g.remove',
+                type='raster',
+                name=cache,
+                flags='f')
+
+    except CalledModuleError:
+        pass
+
+
+if __name__ == '__main__':
+    atexit.register(cleanup)
+    main()
+    sys.exit(0)
@@ -0,0 +1,868 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+MODULE:    Test of r.erosion
+
+AUTHOR(S): Brendan Harmon <brendan.harmon@gmail.com>
+
+PURPOSE:   Regression tests of r.erosion against reference arrays
+           computed from synthetic elevation models,
+           with time and memory budgets for each model
+
+COPYRIGHT: (C) 2019 Brendan Harmon and the GRASS Development Team
+
+           This program is free software under the GNU General Public
+           License (>=v2). Read the file COPYING that comes with GRASS
+           for details.
+
+USAGE:     grass --tmp-location XY --exec python testsuite/test_r_erosion.py
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import grass.script as gscript
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+from grass.gunittest.gmodules import SimpleModule
+from grass.script import array as garray
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# time (s) and peak memory (MB) budgets for each model
+# on the synthetic elevation models of 400 by 400 cells,
+# a few times their expected runtime and memory
+# so that a severalfold slowdown fails the test
+budgets = {
+    'rusle': (8.0, 120.0),
+    'usped': (15.0, 120.0),
+    'event': (8.0, 120.0),
+    'ensemble': (15.0, 250.0),
+    'cache': (8.0, 120.0)}
+
+# run a command in a fresh process and print the peak resident memory
+# of the processes it waited for in kB on Linux
+measure = """\
+import resource, subprocess, sys
+returncode = subprocess.call(sys.argv[1:])
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+sys.exit(returncode)
+"""
+
+# relative tolerance for comparison with reference arrays
+rtol = 1e-5
+
+# conversion from tons/ha/yr to kg/m^2s
+ton_ha_yr_to_kg_m2_s = 1000. / 10000. / 31557600.
+
+
+def epoch_name(name, epoch):
+    """Name an output map after the epoch of its elevation model"""
+    return "{name}_{epoch}".format(name=name, epoch=epoch)
+
+
+class TestErosion(TestCase):
+    """Compare the outputs of r.erosion on synthetic elevation models
+    with reference arrays computed from the model equations"""
+
+    # synthetic elevation models
+    hill = 'test_hill'
+    plane = 'test_plane'
+    size = 400
+
+    # model parameters
+    r_factor = 310.0
+    k_factor = 0.25
+    c_factor = 0.1
+    m_coeff = 1.5
+    n_coeff = 1.2
+
+    # outputs
+    erosion = 'test_erosion'
+    flow_accumulation = 'test_flow_accumulation'
+    ls_factor = 'test_ls_factor'
+
+    @classmethod
+    def setUpClass(cls):
+        """Create synthetic elevation models in a temporary region"""
+        cls.use_temp_region()
+        cls.runModule(
+            'g.region', n=cls.size, s=0, e=cls.size, w=0, res=1)
+        cls.runModule(
+            'r.mapcalc',
+            expression="{hill}=20*exp(-((x()-{center})^2+(y()-{center})^2)"
+            "/{spread})+0.05*y()".format(
+                hill=cls.hill,
+                center=cls.size / 2.,
+                spread=cls.size ** 2 / 12.),
+            overwrite=True)
+        cls.runModule(
+            'r.mapcalc',
+            expression="{plane}=0.1*x()".format(plane=cls.plane),
+            overwrite=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Remove synthetic elevation models and the temporary region"""
+        cls.runModule(
+            'g.remove',
+            type='raster',
+            name=[cls.hill, cls.plane],
+            flags='f')
+        cls.del_temp_region()
+
+    def tearDown(self):
+        """Remove outputs and reference maps"""
+        self.runModule(
+            'g.remove',
+            type='raster',
+            pattern='test_*',
+            exclude='{hill}|{plane}'.format(hill=self.hill, plane=self.plane),
+            flags='f')
+
+    def run_within_budget(self, budget, flags='', **kwargs):
+        """Run r.erosion and check its time and memory budget,
+        measuring memory for this run alone in a fresh process,
+        and return its standard error"""
+        seconds, megabytes = budgets[budget]
+        command = gscript.make_command(
+            'r.erosion', flags=flags, overwrite=True, **kwargs)
+        if resource:
+            command = [sys.executable, '-c', measure] + command
+        start = time.time()
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        elapsed = time.time() - start
+        stdout, stderr = gscript.decode(stdout), gscript.decode(stderr)
+        self.assertEqual(process.returncode, 0, msg=stderr)
+        self.assertLess(
+            elapsed, seconds,
+            msg="{budget} took {elapsed:.1f} s".format(
+                budget=budget, elapsed=elapsed))
+        if resource:
+            peak = float(stdout.splitlines()[-1]) / 1024.
+            self.assertLess(
+                peak, megabytes,
+                msg="{budget} used {peak:.0f} MB".format(
+                    budget=budget, peak=peak))
+        return stderr
+
+    def reference_terrain(self, elevation):
+        """Compute reference slope (degrees) and flow depth arrays"""
+        self.runModule(
+            'r.slope.aspect',
+            elevation=elevation,
+            slope='test_slope',
+            aspect='test_aspect',
+            overwrite=True)
+        self.runModule(
+            'r.grow.distance',
+            input='test_slope',
+            value='test_grow_slope',
+            overwrite=True)
+        self.runModule(
+            'r.grow.distance',
+            input='test_aspect',
+            value='test_grow_aspect',
+            overwrite=True)
+        self.runModule(
+            'r.watershed',
+            elevation=elevation,
+            accumulation='test_flowacc',
+            flags='a',
+            overwrite=True)
+        slope = garray.array(mapname='test_grow_slope')
+        aspect = garray.array(mapname='test_grow_aspect')
+        depth = garray.array(mapname='test_flowacc') * 1.0
+        return slope, aspect, depth
+
+    def assertArrayClose(self, name, reference):
+        """Compare a raster map with a reference array"""
+        np.testing.assert_allclose(
+            garray.array(mapname=name), reference,
+            rtol=rtol, atol=1e-12, equal_nan=True)
+
+    def rusle_reference(self, slope, depth, r_factor):
+        """Compute reference LS factor and erosion arrays of RUSLE3D"""
+        ls_factor = ((self.m_coeff + 1.0)
+                     * (depth / 22.1) ** self.m_coeff
+                     * (np.sin(np.radians(slope)) / 5.14) ** self.n_coeff)
+        erosion = (r_factor * self.k_factor * ls_factor * self.c_factor
+                   * ton_ha_yr_to_kg_m2_s)
+        return ls_factor, erosion
+
+    def test_rusle(self):
+        """RUSLE3D outputs match reference arrays"""
+        self.run_within_budget(
+            'rusle',
+            elevation=self.hill,
+            model='rusle',
+            erosion=self.erosion,
+            flow_accumulation=self.flow_accumulation,
+            ls_factor=self.ls_factor)
+        slope, aspect, depth = self.reference_terrain(self.hill)
+        ls_factor, erosion = self.rusle_reference(
+            slope, depth, self.r_factor)
+        self.assertArrayClose(self.flow_accumulation, depth)
+        self.assertArrayClose(self.ls_factor, ls_factor)
+        self.assertArrayClose(self.erosion, erosion)
+
+    def test_rusle_without_optional_outputs(self):
+        """RUSLE3D erosion does not depend on optional outputs"""
+        self.run_within_budget(
+            'rusle',
+            elevation=self.hill,
+            model='rusle',
+            erosion=self.erosion)
+        self.assertRasterDoesNotExist(self.flow_accumulation)
+        self.assertRasterDoesNotExist(self.ls_factor)
+        slope, aspect, depth = self.reference_terrain(self.hill)
+        ls_factor, erosion = self.rusle_reference(
+            slope, depth, self.r_factor)
+        self.assertArrayClose(self.erosion, erosion)
+
+    def test_rusle_plane(self):
+        """RUSLE3D LS factor on a plane matches the analytic slope"""
+        self.run_within_budget(
+            'rusle',
+            elevation=self.plane,
+            model='rusle',
+            erosion=self.erosion,
+            flow_accumulation=self.flow_accumulation,
+            ls_factor=self.ls_factor)
+        depth = garray.array(mapname=self.flow_accumulation)
+        ls_factor = ((self.m_coeff + 1.0)
+                     * (depth / 22.1) ** self.m_coeff
+                     * (np.sin(np.arctan(0.1)) / 5.14) ** self.n_coeff)
+        self.assertArrayClose(self.ls_factor, ls_factor)
+
+    def test_usped(self):
+        """USPED outputs match reference arrays"""
+        self.run_within_budget(
+            'usped',
+            elevation=self.hill,
+            model='usped',
+            erosion=self.erosion,
+            flow_accumulation=self.flow_accumulation,
+            ls_factor=self.ls_factor)
+        slope, aspect, depth = self.reference_terrain(self.hill)
+        ls_factor = (depth ** self.m_coeff
+                     * np.sin(np.radians(slope)) ** self.n_coeff)
+        sediment_flux = (self.r_factor * self.k_factor * self.c_factor
+                         * ls_factor * ton_ha_yr_to_kg_m2_s)
+        self.assertArrayClose(self.flow_accumulation, depth)
+        self.assertArrayClose(self.ls_factor, ls_factor)
+
+        # reference divergence of sediment flow
+        for name, values in [
+                ('test_qsx', sediment_flux * np.cos(np.radians(aspect))),
+                ('test_qsy', sediment_flux * np.sin(np.radians(aspect)))]:
+            array = garray.array()
+            array[...] = values
+            array.write(mapname=name, overwrite=True)
+        self.runModule(
+            'r.slope.aspect', elevation='test_qsx', dx='test_qsxdx',
+            overwrite=True)
+        self.runModule(
+            'r.slope.aspect', elevation='test_qsy', dy='test_qsydy',
+            overwrite=True)
+        for name in ['test_qsxdx', 'test_qsydy']:
+            self.runModule(
+                'r.grow.distance', input=name, value=name + '_grow',
+                overwrite=True)
+        erosion = (garray.array(mapname='test_qsxdx_grow')
+                   + garray.array(mapname='test_qsydy_grow'))
+        np.testing.assert_allclose(
+            garray.array(mapname=self.erosion), erosion,
+            rtol=1e-4, atol=1e-15, equal_nan=True)
+
+    def test_event_based_r_factor(self):
+        """Erosion with an event-based R factor matches the closed form"""
+        intensity, duration = 50, 60
+        self.run_within_budget(
+            'event',
+            elevation=self.hill,
+            model='rusle',
+            rain_intensity=intensity,
+            rain_duration=duration,
+            erosion=self.erosion,
+            ls_factor=self.ls_factor)
+        energy = 0.29 * (1. - 0.72 * np.exp(-0.05 * intensity))
+        volume = intensity * (duration / 60.)
+        r_factor = energy * volume * intensity / (duration / 525600.)
+        erosion = (r_factor * self.k_factor * self.c_factor
+                   * garray.array(mapname=self.ls_factor)
+                   * ton_ha_yr_to_kg_m2_s)
+        self.assertArrayClose(self.erosion, erosion)
+
+    def create_rainfall(self, intensity, duration):
+        """Create a one step rainfall time series of constant intensity"""
+        self.runModule(
+            'r.mapcalc',
+            expression="test_rain={intensity}".format(intensity=intensity),
+            overwrite=True)
+        self.runModule(
+            't.create',
+            output='test_rainfall',
+            type='strds',
+            temporaltype='relative',
+            title='Rainfall',
+            description='Rainfall intensity (mm/hr)',
+            overwrite=True)
+        self.addCleanup(
+            self.runModule, 't.remove', inputs='test_rainfall', flags='f')
+        self.runModule(
+            't.register',
+            input='test_rainfall',
+            maps='test_rain',
+            start=0,
+            end=duration,
+            unit='minutes',
+            overwrite=True)
+
+    def test_estimate(self):
+        """Estimates print the costs read by the batch script
+        without writing maps and count the cells outside the mask"""
+        env = gscript.gisenv()
+        before = gscript.list_strings('raster', mapset=env['MAPSET'])
+        module = SimpleModule(
+            'r.erosion',
+            flags='e',
+            elevation=self.hill,
+            model='rusle',
+            erosion=self.erosion,
+            ls_factor=self.ls_factor)
+        self.assertModule(module)
+        self.assertEqual(
+            gscript.list_strings('raster', mapset=env['MAPSET']), before)
+        estimate = gscript.parse_key_val(module.outputs.stdout)
+        for key in ['masked_cells', 'runtime_seconds', 'peak_memory_mb']:
+            self.assertIn(key, estimate)
+        self.assertEqual(int(estimate['cells']), self.size ** 2)
+        self.assertEqual(int(estimate['masked_cells']), self.size ** 2)
+        self.assertGreater(float(estimate['runtime_seconds']), 0)
+        self.assertGreater(float(estimate['peak_memory_mb']), 0)
+
+        # mask the western half of the region
+        self.runModule(
+            'r.mapcalc',
+            expression="test_mask=if(x()<{half},1,null())".format(
+                half=self.size / 2.),
+            overwrite=True)
+        self.runModule('r.mask', raster='test_mask')
+        try:
+            module = SimpleModule(
+                'r.erosion',
+                flags='e',
+                elevation=self.hill,
+                model='rusle',
+                erosion=self.erosion)
+            self.assertModule(module)
+        finally:
+            self.runModule('r.mask', flags='r')
+        estimate = gscript.parse_key_val(module.outputs.stdout)
+        self.assertEqual(int(estimate['cells']), self.size ** 2)
+        self.assertEqual(int(estimate['masked_cells']), self.size ** 2 // 2)
+
+    def test_space_time_r_factor(self):
+        """A one step rainfall time series matches the event-based R factor"""
+        intensity, duration = 50, 60
+        self.create_rainfall(intensity, duration)
+        self.run_within_budget(
+            'event',
+            elevation=self.hill,
+            model='rusle',
+            rainfall='test_rainfall',
+            erosion=self.erosion,
+            ls_factor=self.ls_factor)
+        energy = 0.29 * (1. - 0.72 * np.exp(-0.05 * intensity))
+        volume = intensity * (duration / 60.)
+        r_factor = energy * volume * intensity / (duration / 525600.)
+        erosion = (r_factor * self.k_factor * self.c_factor
+                   * garray.array(mapname=self.ls_factor)
+                   * ton_ha_yr_to_kg_m2_s)
+        self.assertArrayClose(self.erosion, erosion)
+
+    def test_scratch(self):
+        """A run in a scratch mapset copies only its outputs
+        into the current mapset and removes the scratch mapset"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        env = gscript.gisenv()
+        location = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+
+        # an unqualified rainfall time series of the current mapset
+        self.create_rainfall(50, 60)
+        self.run_within_budget(
+            'event',
+            elevation=self.hill,
+            model='rusle',
+            rainfall='test_rainfall',
+            erosion='test_reference')
+
+        # maps of the user with the names of intermediate maps
+        for name, value in [('slope', 1), ('flowacc', 2)]:
+            self.runModule(
+                'r.mapcalc',
+                expression="{name}={value}".format(name=name, value=value),
+                overwrite=True)
+        self.addCleanup(
+            self.runModule, 'g.remove', type='raster',
+            name=['slope', 'flowacc'], flags='f')
+        before = set(gscript.list_strings('raster', mapset=env['MAPSET']))
+        self.run_within_budget(
+            'event',
+            elevation=self.hill,
+            model='rusle',
+            rainfall='test_rainfall',
+            erosion=self.erosion,
+            ls_factor=self.ls_factor,
+            scratch=directory)
+        after = set(gscript.list_strings('raster', mapset=env['MAPSET']))
+        self.assertEqual(
+            sorted(after - before),
+            sorted('{name}@{mapset}'.format(name=name, mapset=env['MAPSET'])
+                   for name in [self.erosion, self.ls_factor]))
+        self.assertArrayClose(
+            self.erosion, garray.array(mapname='test_reference'))
+        np.testing.assert_array_equal(garray.array(mapname='slope'), 1)
+        np.testing.assert_array_equal(garray.array(mapname='flowacc'), 2)
+        self.assertFalse([name for name in os.listdir(location)
+                          if name.startswith('r_erosion_scratch_')])
+        self.assertEqual(os.listdir(directory), [])
+
+        # a checkpointed scratch mapset is kept and resumed
+        mapset = 'r_erosion_scratch_{mapset}'.format(mapset=env['MAPSET'])
+        link = os.path.join(location, mapset)
+        self.addCleanup(
+            lambda: os.path.islink(link) and os.remove(link))
+        for resumed in [False, True]:
+            stderr = self.run_within_budget(
+                'event',
+                flags='c',
+                elevation=self.hill,
+                model='rusle',
+                rainfall='test_rainfall',
+                erosion=self.erosion,
+                scratch=directory)
+            self.assertEqual("Resuming stage" in stderr, resumed)
+            self.assertTrue(os.path.islink(link))
+            self.assertTrue(os.path.isdir(os.path.join(directory, mapset)))
+        self.assertArrayClose(
+            self.erosion, garray.array(mapname='test_reference'))
+        np.testing.assert_array_equal(garray.array(mapname='slope'), 1)
+
+    def test_query(self):
+        """Queries at points and in areas match a full RUSLE3D run"""
+        self.assertModule(SimpleModule(
+            'r.erosion',
+            elevation=self.hill,
+            model='rusle',
+            erosion=self.erosion,
+            overwrite=True))
+        erosion = garray.array(mapname=self.erosion)
+        region = gscript.region()
+        rows, cols = int(region['rows']), int(region['cols'])
+
+        # sample cell centers at points
+        cells = [(rows // 4, cols // 4),
+                 (rows // 2, cols // 3),
+                 (3 * rows // 4, 2 * cols // 3)]
+        coordinates = []
+        for row, col in cells:
+            coordinates.extend([region['w'] + (col + 0.5) * region['ewres'],
+                                region['n'] - (row + 0.5) * region['nsres']])
+        module = SimpleModule(
+            'r.erosion',
+            elevation=self.hill,
+            model='rusle',
+            coordinates=coordinates,
+            table='-')
+        self.assertModule(module)
+        lines = module.outputs.stdout.splitlines()
+        self.assertEqual(lines[0].split(',')[-1], 'erosion')
+        np.testing.assert_allclose(
+            [float(line.split(',')[-1]) for line in lines[1:]],
+            [erosion[row, col] for row, col in cells],
+            rtol=rtol)
+
+        # summarize erosion in an area of a quarter of the region
+        first_row, last_row = rows // 4, 3 * rows // 4
+        first_col, last_col = cols // 4, 3 * cols // 4
+        self.runModule(
+            'g.region',
+            n=region['n'] - first_row * region['nsres'],
+            s=region['n'] - last_row * region['nsres'],
+            w=region['w'] + first_col * region['ewres'],
+            e=region['w'] + last_col * region['ewres'])
+        self.runModule('v.in.region', output='test_aoi', overwrite=True)
+        self.runModule(
+            'g.region',
+            n=region['n'], s=region['s'], e=region['e'], w=region['w'],
+            nsres=region['nsres'], ewres=region['ewres'])
+        try:
+            module = SimpleModule(
+                'r.erosion',
+                elevation=self.hill,
+                model='rusle',
+                aoi='test_aoi',
+                table='-')
+            self.assertModule(module)
+        finally:
+            self.runModule(
+                'g.remove', type='vector', name='test_aoi', flags='f')
+            self.runModule(
+                'g.remove', type='raster', pattern='r_erosion_query_*',
+                flags='f')
+        lines = module.outputs.stdout.splitlines()
+        zone = dict(zip(lines[0].split(','), lines[1].split(',')))
+        area = erosion[first_row:last_row, first_col:last_col]
+        self.assertEqual(int(zone['cells']), area.size)
+        np.testing.assert_allclose(
+            float(zone['erosion_mean']), np.nanmean(area), rtol=rtol)
+
+    def test_time_series(self):
+        """Epochs of a time series match single runs and their differences"""
+        self.assertModule(SimpleModule(
+            'r.erosion',
+            elevation=[self.hill, self.plane],
+            model='rusle',
+            erosion=self.erosion,
+            flow_accumulation=self.flow_accumulation,
+            erosion_difference='test_difference',
+            nprocs=2,
+            overwrite=True))
+        self.assertRasterDoesNotExist(self.erosion)
+        for elevation in [self.hill, self.plane]:
+            self.assertModule(SimpleModule(
+                'r.erosion',
+                elevation=elevation,
+                model='rusle',
+                erosion='test_single',
+                flow_accumulation='test_single_flowacc',
+                overwrite=True))
+            self.assertArrayClose(
+                epoch_name(self.erosion, elevation),
+                garray.array(mapname='test_single'))
+            self.assertArrayClose(
+                epoch_name(self.flow_accumulation, elevation),
+                garray.array(mapname='test_single_flowacc'))
+        self.assertArrayClose(
+            'test_difference_{later}_{earlier}'.format(
+                later=self.plane, earlier=self.hill),
+            garray.array(mapname=epoch_name(self.erosion, self.plane))
+            - garray.array(mapname=epoch_name(self.erosion, self.hill)))
+
+    def test_time_series_fatal_error(self):
+        """A fatal error in a parallel epoch ends the run instead of hanging"""
+        command = gscript.make_command(
+            'r.erosion',
+            flags='f',
+            elevation=[self.hill, self.plane],
+            model='rusle',
+            erosion=self.erosion,
+            members=400,
+            seed=1,
+            erosion_mean='test_mean',
+            memory=100,
+            nprocs=2,
+            overwrite=True)
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = process.communicate(timeout=120)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            self.fail("r.erosion did not exit after a fatal error")
+        self.assertNotEqual(process.returncode, 0)
+        self.assertIn("LS factor tables", gscript.decode(stderr))
+
+    def read_stack(self, path, stack_format):
+        """Return the scenarios and erosion array of an array store"""
+        if stack_format == 'zarr':
+            import zarr
+            store = zarr.open_group(path, mode='r')
+            return (list(store.attrs['scenarios']),
+                    np.asarray(store['erosion'][:]))
+        import netCDF4
+        with netCDF4.Dataset(path) as store:
+            return (list(store.variables['scenario'][:]),
+                    np.ma.filled(store.variables['erosion'][:], np.nan))
+
+    def test_stack(self):
+        """Scenarios written to array stores are read back and overwritten"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for stack_format, library in [('zarr', 'zarr'), ('netcdf', 'netCDF4')]:
+            with self.subTest(stack_format=stack_format):
+                try:
+                    __import__(library)
+                except ImportError:
+                    self.skipTest("{library} is not installed".format(
+                        library=library))
+                path = os.path.join(directory, 'stack_' + stack_format)
+
+                # append scenarios and overwrite a scenario by name
+                erosion = {}
+                for scenario, elevation in [('a', self.hill),
+                                            ('b', self.plane),
+                                            ('a', self.plane)]:
+                    self.assertModule(SimpleModule(
+                        'r.erosion',
+                        elevation=elevation,
+                        model='rusle',
+                        erosion=self.erosion,
+                        stack=path,
+                        stack_format=stack_format,
+                        scenario=scenario,
+                        tile=128,
+                        overwrite=True))
+                    erosion[scenario] = garray.array(mapname=self.erosion)
+                scenarios, values = self.read_stack(path, stack_format)
+                self.assertEqual(scenarios, ['a', 'b'])
+                for index, scenario in enumerate(scenarios):
+                    np.testing.assert_allclose(
+                        values[index], erosion[scenario],
+                        rtol=rtol, equal_nan=True)
+
+                # a store of another region is not written
+                self.runModule('g.region', res=2)
+                try:
+                    self.assertModuleFail(SimpleModule(
+                        'r.erosion',
+                        elevation=self.hill,
+                        model='rusle',
+                        erosion=self.erosion,
+                        stack=path,
+                        stack_format=stack_format,
+                        scenario='c',
+                        overwrite=True))
+                finally:
+                    self.runModule('g.region', res=1)
+                self.assertEqual(
+                    self.read_stack(path, stack_format)[0], ['a', 'b'])
+
+    def resumed_stages(self, flags='c', **kwargs):
+        """Run RUSLE3D and return the stages resumed from checkpoints"""
+        stderr = self.run_within_budget(
+            'rusle',
+            flags=flags,
+            model='rusle',
+            erosion=self.erosion,
+            ls_factor=self.ls_factor,
+            **kwargs)
+        return set(re.findall(
+            r"Resuming stage (\S+) from checkpoint", stderr))
+
+    def remove_checkpoints(self):
+        """Remove the checkpoint file and kept intermediate maps"""
+        env = gscript.gisenv()
+        path = os.path.join(
+            env['GISDBASE'],
+            env['LOCATION_NAME'],
+            env['MAPSET'],
+            'r.erosion',
+            'checkpoint.json')
+        if os.path.exists(path):
+            os.remove(path)
+        self.runModule(
+            'g.remove',
+            type='raster',
+            name=['slope', 'grow_slope', 'flowacc'],
+            flags='f')
+
+    def test_checkpoint_resume(self):
+        """A rerun with -c resumes all stages with identical outputs"""
+        self.addCleanup(self.remove_checkpoints)
+        self.remove_checkpoints()
+        self.assertEqual(self.resumed_stages(elevation=self.hill), set())
+        erosion = garray.array(mapname=self.erosion)
+        ls_factor = garray.array(mapname=self.ls_factor)
+        self.assertEqual(
+            self.resumed_stages(elevation=self.hill),
+            {'r_factor', 'k_factor', 'c_factor', 'slope',
+             'flow_accumulation', 'rusle_ls_factor', 'rusle_erosion'})
+        np.testing.assert_array_equal(
+            garray.array(mapname=self.erosion), erosion)
+        np.testing.assert_array_equal(
+            garray.array(mapname=self.ls_factor), ls_factor)
+
+    def test_checkpoint_invalidation(self):
+        """Changed parameters and inputs recompute their stages
+        and every stage downstream of them"""
+        self.addCleanup(self.remove_checkpoints)
+        self.remove_checkpoints()
+        self.runModule(
+            'g.copy', raster=[self.hill, 'test_hill_copy'], overwrite=True)
+        self.resumed_stages(elevation='test_hill_copy')
+
+        # the m coefficient changes the LS factor and erosion
+        self.assertEqual(
+            self.resumed_stages(elevation='test_hill_copy', m_coeff=1.4),
+            {'r_factor', 'k_factor', 'c_factor', 'slope',
+             'flow_accumulation'})
+
+        # a rewritten elevation map changes the terrain and all later stages
+        time.sleep(1)
+        self.runModule(
+            'r.mapcalc',
+            expression="test_hill_copy={hill}".format(hill=self.hill),
+            overwrite=True)
+        self.assertEqual(
+            self.resumed_stages(elevation='test_hill_copy', m_coeff=1.4),
+            {'r_factor', 'k_factor', 'c_factor'})
+
+    def test_checkpoint_removed_without_flag(self):
+        """A run without -c removes intermediate maps
+        so that the next run with -c recomputes all stages"""
+        self.addCleanup(self.remove_checkpoints)
+        self.remove_checkpoints()
+        self.resumed_stages(elevation=self.hill)
+        self.assertRasterExists('slope')
+        self.assertEqual(
+            self.resumed_stages(flags='', elevation=self.hill), set())
+        for name in ['slope', 'grow_slope', 'flowacc']:
+            self.assertRasterDoesNotExist(name)
+        self.assertEqual(self.resumed_stages(elevation=self.hill), set())
+
+    def test_ensemble_without_uncertainty(self):
+        """An ensemble without uncertainty reproduces the deterministic run"""
+        self.run_within_budget(
+            'ensemble',
+            elevation=self.hill,
+            model='rusle',
+            erosion=self.erosion,
+            members=20,
+            seed=1,
+            batch=6,
+            percentiles=[50],
+            erosion_mean='test_mean',
+            erosion_stddev='test_stddev',
+            erosion_percentile='test_percentile')
+        erosion = garray.array(mapname=self.erosion)
+        self.assertArrayClose('test_mean', erosion)
+        self.assertArrayClose('test_percentile_50', erosion)
+        np.testing.assert_allclose(
+            garray.array(mapname='test_stddev'), 0.0,
+            atol=1e-12 * np.nanmax(erosion))
+
+    def test_ensemble_fast_math(self):
+        """An ensemble with LS factor tables stays within their error bound"""
+        self.run_within_budget(
+            'ensemble',
+            elevation=self.hill,
+            model='rusle',
+            erosion=self.erosion,
+            members=4,
+            seed=1,
+            erosion_mean='test_mean',
+            flags='f')
+        erosion = garray.array(mapname=self.erosion)
+        np.testing.assert_allclose(
+            garray.array(mapname='test_mean'), erosion,
+            rtol=1e-3, atol=1e-6 * np.nanmax(erosion), equal_nan=True)
+
+    def cache_index(self):
+        """Return the index of cached runs"""
+        env = gscript.gisenv()
+        path = os.path.join(
+            env['GISDBASE'],
+            env['LOCATION_NAME'],
+            'r_erosion_cache',
+            'cache.json')
+        with open(path) as cache_file:
+            return json.load(cache_file)
+
+    def cached_runs(self):
+        """Return the output maps of each cached run"""
+        return {key: [output for output, cached in run['outputs']]
+                for key, run in self.cache_index().items()}
+
+    def run_cached(self, cache_size=100, flags='', **kwargs):
+        """Run RUSLE3D with the cache and return whether it was a hit"""
+        stderr = self.run_within_budget(
+            'cache',
+            flags=flags,
+            model='rusle',
+            cache_size=cache_size,
+            **kwargs)
+        return "from cache" in stderr
+
+    def test_cache_hit_and_miss(self):
+        """Identical runs reuse cached outputs and other runs do not"""
+        self.addCleanup(self.runModule, 'r.erosion', flags='i')
+        self.assertFalse(self.run_cached(
+            elevation=self.hill, erosion=self.erosion))
+        erosion = garray.array(mapname=self.erosion)
+        self.runModule(
+            'g.remove', type='raster', name=self.erosion, flags='f')
+        self.assertTrue(self.run_cached(
+            elevation=self.hill, erosion=self.erosion))
+        self.assertArrayClose(self.erosion, erosion)
+        self.assertEqual(len(self.cached_runs()), 1)
+
+        # other parameters and flags that change outputs miss
+        self.assertFalse(self.run_cached(
+            elevation=self.hill, erosion=self.erosion, m_coeff=1.4))
+        self.assertFalse(self.run_cached(
+            elevation=self.hill, erosion=self.erosion, flags='f'))
+        self.assertEqual(len(self.cached_runs()), 3)
+
+    def test_cache_invalidated_by_input(self):
+        """A rewritten input map invalidates cached outputs"""
+        self.addCleanup(self.runModule, 'r.erosion', flags='i')
+        self.runModule(
+            'g.copy', raster=[self.hill, 'test_hill_copy'], overwrite=True)
+        self.assertFalse(self.run_cached(
+            elevation='test_hill_copy', erosion=self.erosion))
+        time.sleep(1)
+        self.runModule(
+            'r.mapcalc',
+            expression="test_hill_copy={hill}".format(hill=self.hill),
+            overwrite=True)
+        self.assertFalse(self.run_cached(
+            elevation='test_hill_copy', erosion=self.erosion))
+        self.assertEqual(len(self.cached_runs()), 2)
+
+    def test_cache_eviction(self):
+        """The least recently used runs are evicted over the size limit"""
+        self.addCleanup(self.runModule, 'r.erosion', flags='i')
+        self.run_cached(elevation=self.hill, erosion='test_erosion_a')
+        size = max(run['size'] for run in self.cache_index().values())
+
+        # room for two runs of the same size
+        cache_size = 2.5 * size / 1024. ** 2
+        self.run_cached(cache_size=cache_size,
+                        elevation=self.hill, erosion='test_erosion_b')
+        self.assertTrue(self.run_cached(
+            cache_size=cache_size,
+            elevation=self.hill, erosion='test_erosion_a'))
+        self.run_cached(cache_size=cache_size,
+                        elevation=self.hill, erosion='test_erosion_c')
+        self.assertEqual(
+            sorted(self.cached_runs().values()),
+            [['test_erosion_a'], ['test_erosion_c']])
+
+    def test_cache_invalidation(self):
+        """The -i flag removes all cached runs and their maps"""
+        self.run_cached(elevation=self.hill, erosion=self.erosion)
+        self.assertModule(SimpleModule('r.erosion', flags='i'))
+        self.assertEqual(self.cached_runs(), {})
+        self.assertFalse(gscript.list_strings(
+            'raster', pattern='run_*', mapset='r_erosion_cache'))
+
+
+if __name__ == '__main__':
+    test()
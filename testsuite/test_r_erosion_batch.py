@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+MODULE:    Test of r.erosion.batch
+
+AUTHOR(S): Brendan Harmon <brendan.harmon@gmail.com>
+
+PURPOSE:   Tests of the scheduler and the table of erosion statistics
+           of each area of interest of r.erosion.batch
+
+COPYRIGHT: (C) 2019 Brendan Harmon and the GRASS Development Team
+
+           This program is free software under the GNU General Public
+           License (>=v2). Read the file COPYING that comes with GRASS
+           for details.
+
+USAGE:     grass --tmp-location XY --exec python testsuite/test_r_erosion_batch.py
+"""
+
+import os
+import sys
+import time
+import types
+import shutil
+import tempfile
+import subprocess
+import threading
+from importlib.machinery import SourceFileLoader
+import grass.script as gscript
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+# path of the batch script
+script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir,
+    'scripts',
+    'r.erosion.batch.py')
+
+
+def load_batch():
+    """Load the batch script as a module"""
+    loader = SourceFileLoader('r_erosion_batch', script)
+    module = types.ModuleType(loader.name)
+    loader.exec_module(module)
+    return module
+
+
+class TestSchedule(TestCase):
+    """Run jobs that record their concurrency instead of r.erosion"""
+
+    def schedule(self, jobs, nprocs, memory):
+        """Schedule jobs and return the order they started in
+        and the peak number of running jobs and memory of concurrent jobs"""
+        batch = load_batch()
+        lock = threading.Lock()
+        running = {'jobs': 0, 'memory': 0}
+        peak = {'jobs': 0, 'memory': 0}
+        started = []
+
+        def run_job(job, options, parameters):
+            with lock:
+                started.append(job['cat'])
+                running['jobs'] += 1
+                running['memory'] += job['memory']
+                peak['jobs'] = max(peak['jobs'], running['jobs'])
+                if running['jobs'] > 1:
+                    peak['memory'] = max(peak['memory'], running['memory'])
+            time.sleep(job['seconds'])
+            with lock:
+                running['jobs'] -= 1
+                running['memory'] -= job['memory']
+            job['statistics'] = {}
+
+        batch.run_job = run_job
+        batch.schedule(jobs, nprocs, memory, {}, {})
+        return started, peak
+
+    def test_longest_first(self):
+        """Jobs start longest first on up to nprocs cores"""
+        jobs = [{'cat': cat, 'seconds': seconds, 'memory': 10}
+                for cat, seconds in [(1, 0.1), (2, 0.3), (3, 0.2), (4, 0.1)]]
+        started, peak = self.schedule(jobs, nprocs=2, memory=100)
+        self.assertEqual(sorted(started[:2]), [2, 3])
+        self.assertEqual(sorted(started), [1, 2, 3, 4])
+        self.assertEqual(peak['jobs'], 2)
+        self.assertTrue(all('statistics' in job for job in jobs))
+
+    def test_memory_budget(self):
+        """Running jobs fit into the memory budget
+        and a job larger than the budget runs on its own"""
+        jobs = [{'cat': cat, 'seconds': 0.1, 'memory': memory}
+                for cat, memory in [(1, 60), (2, 60), (3, 30), (4, 150)]]
+        started, peak = self.schedule(jobs, nprocs=4, memory=100)
+        self.assertEqual(sorted(started), [1, 2, 3, 4])
+        self.assertLessEqual(peak['memory'], 100)
+        self.assertTrue(all('statistics' in job for job in jobs))
+
+
+class TestBatch(TestCase):
+    """Run r.erosion.batch for two areas of interest of a synthetic hill"""
+
+    hill = 'test_batch_hill'
+    aoi = 'test_batch_aoi'
+    size = 100
+
+    @classmethod
+    def setUpClass(cls):
+        """Create a synthetic hill and two areas of interest"""
+        cls.use_temp_region()
+        cls.runModule(
+            'g.region', n=cls.size, s=0, e=cls.size, w=0, res=1)
+        cls.runModule(
+            'r.mapcalc',
+            expression="{hill}=20*exp(-((x()-{center})^2+(y()-{center})^2)"
+            "/{spread})+0.05*y()".format(
+                hill=cls.hill,
+                center=cls.size / 2.,
+                spread=cls.size ** 2 / 12.),
+            overwrite=True)
+
+        # western and eastern halves of the region
+        for cat, west, east in [(1, 0, cls.size // 2),
+                                (2, cls.size // 2, cls.size)]:
+            cls.runModule('g.region', w=west, e=east)
+            cls.runModule(
+                'v.in.region',
+                output='{aoi}_{cat}'.format(aoi=cls.aoi, cat=cat),
+                cat=cat,
+                overwrite=True)
+        cls.runModule('g.region', w=0, e=cls.size)
+        cls.runModule(
+            'v.patch',
+            input=['{aoi}_1'.format(aoi=cls.aoi),
+                   '{aoi}_2'.format(aoi=cls.aoi)],
+            output=cls.aoi,
+            overwrite=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Remove the hill, the areas of interest and the temporary region"""
+        cls.runModule(
+            'g.remove', type='raster', name=cls.hill, flags='f')
+        cls.runModule(
+            'g.remove', type='vector', pattern=cls.aoi + '*', flags='f')
+        cls.del_temp_region()
+
+    def tearDown(self):
+        """Remove outputs"""
+        self.runModule(
+            'g.remove', type='raster', pattern='test_batch_erosion_*',
+            flags='f')
+
+    def test_table(self):
+        """Each area of interest gets an output map and a row of statistics
+        and the mapsets of jobs are removed"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        table = os.path.join(directory, 'table.csv')
+        process = subprocess.Popen(
+            [sys.executable, script,
+             'elevation={hill}'.format(hill=self.hill),
+             'aoi={aoi}'.format(aoi=self.aoi),
+             'erosion=test_batch_erosion',
+             'table={table}'.format(table=table),
+             'memory=300',
+             'nprocs=0'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, msg=gscript.decode(stderr))
+
+        with open(table) as table_file:
+            lines = table_file.read().splitlines()
+        self.assertEqual(
+            lines[0],
+            "cat,cells,seconds,memory_mb,erosion_mean,"
+            "erosion_min,erosion_max,erosion_sum")
+        rows = [dict(zip(lines[0].split(','), line.split(',')))
+                for line in lines[1:]]
+        self.assertEqual([row['cat'] for row in rows], ['1', '2'])
+        for row in rows:
+            name = 'test_batch_erosion_{cat}'.format(cat=row['cat'])
+            self.assertRasterExists(name)
+            statistics = gscript.parse_command(
+                'r.univar', map=name, flags='g')
+            self.assertEqual(int(row['cells']), int(statistics['n']))
+            self.assertLessEqual(int(row['cells']), self.size ** 2 // 2)
+            self.assertAlmostEqual(
+                float(row['erosion_mean']), float(statistics['mean']),
+                delta=1e-6 * abs(float(statistics['mean'])))
+
+        env = gscript.gisenv()
+        location = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+        self.assertFalse([name for name in os.listdir(location)
+                          if name.startswith('r_erosion_batch_')])
+
+
+if __name__ == '__main__':
+    test()